@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+import pandas as pd
+from PIL.Image import Image
+from sklearn.neighbors import KNeighborsClassifier
+
+import match
+import utils
+from config import default_config, LocalPaletteConfig
+from loader import BatchLoader
+from utils import ClassificationTarget
+
+
+def class_associations(
+        coarse: ClassificationTarget,
+        fine: ClassificationTarget,
+        min_share: float = 0.0
+) -> dict[str, set[str]]:
+    """Fine classes associated with each coarse class, from paintings labelled with both in the training CSVs.
+
+    A fine class (e.g. an artist) is associated with a coarse class (e.g. a style) when at least `min_share`
+    of its labelled paintings carry that coarse label.
+    """
+    def labels(target: ClassificationTarget) -> pd.DataFrame:
+        entries = pd.read_csv(
+            os.path.join(default_config.dataset_labels_path, f"{target.name.lower()}_train.csv"),
+            names=["path", "encoded_cls"])
+        cls_encoding = BatchLoader._cls_encoding(target)
+        entries[target.name] = entries["encoded_cls"].apply(lambda x: cls_encoding[x])
+        return entries[["path", target.name]]
+
+    both = labels(coarse).merge(labels(fine), on="path")
+    counts = both.groupby([fine.name, coarse.name]).size()
+    shares = counts / counts.groupby(level=0).transform("sum")
+
+    associations: dict[str, set[str]] = dict()
+    for (fine_cls, coarse_cls), share in shares.items():
+        if share >= min_share:
+            associations.setdefault(coarse_cls, set()).add(fine_cls)
+    return associations
+
+
+class CascadePredictor:
+    """Coarse-to-fine method2 classifier.
+
+    An image is first matched against the (few) coarse class palettes, and only fine classes associated
+    with the `top_k` best coarse classes are matched afterwards. The image is decoded once for both levels.
+    """
+
+    def __init__(
+            self,
+            coarse_palettes: dict[str, np.ndarray],
+            fine_palettes: dict[str, np.ndarray],
+            associations: dict[str, set[str]],
+            top_k: int,
+            config: LocalPaletteConfig | None = None,
+            coarse_transform: utils.PatchTransform | None = None,
+            fine_transform: utils.PatchTransform | None = None
+    ):
+        self.config = config if config is not None else default_config.local_palette
+        self.coarse_palettes = coarse_palettes
+        self.fine_palettes = fine_palettes
+        self.associations = associations
+        self.top_k = top_k
+        self.coarse_transform = coarse_transform
+        self.fine_transform = fine_transform
+        self._neighbours = {
+            cls: KNeighborsClassifier(n_neighbors=1).fit(cls_palette, np.arange(cls_palette.shape[0]))
+            for palettes in (coarse_palettes, fine_palettes) for cls, cls_palette in palettes.items()
+        }
+        # Number of per class matches of the last prediction, to compare against len(fine_palettes)
+        self.last_match_count = 0
+
+    def _scores(self, pixels: np.ndarray, scale: int, palettes: dict[str, np.ndarray], classes,
+                transform: utils.PatchTransform | None) -> dict[str, float]:
+        return match.scores2({
+            cls: match.match2(pixels, palettes[cls], self._neighbours[cls], None, self.config, scale, transform)
+            for cls in classes
+        })
+
+    def candidates(self, coarse_scores: dict[str, float]) -> list[str]:
+        """Fine classes associated with the `top_k` best scoring coarse classes, all of them if there are none."""
+        best = sorted(coarse_scores, key=coarse_scores.get)[:self.top_k]
+        candidates = set().union(*(self.associations.get(cls, set()) for cls in best)) & self.fine_palettes.keys()
+        return sorted(candidates) if candidates else list(self.fine_palettes)
+
+    def predict(self, image: Image) -> str:
+        scale = utils.draft(image, self.config)
+        pixels = utils.image_array(image)
+
+        coarse_scores = self._scores(pixels, scale, self.coarse_palettes, self.coarse_palettes,
+                                     self.coarse_transform)
+        candidates = self.candidates(coarse_scores)
+        fine_scores = self._scores(pixels, scale, self.fine_palettes, candidates, self.fine_transform)
+        self.last_match_count = len(coarse_scores) + len(candidates)
+        return min(fine_scores, key=fine_scores.get)
@@ -0,0 +1,67 @@
+import hashlib
+import json
+import os
+import pickle
+import typing
+
+import config as config_module
+import utils
+from config import default_config
+
+
+class Checkpoint:
+    """Completed training units (fitted transform, batch palettes, merged palettes, class histograms) of a run.
+
+    Every unit is pickled on its own and recorded in `manifest.json` together with the fingerprint of the
+    configuration that produced it. Units recorded under another fingerprint are ignored, so changing the
+    palette configuration, batch size or dataset restarts training instead of mixing stale results in.
+    Files and manifest are replaced atomically, a crash leaves at most the unit in progress unrecorded.
+    """
+
+    def __init__(self, name: str, palette_config: config_module.GlobalPaletteConfig | config_module.LocalPaletteConfig,
+                 *extras: typing.Any):
+        self.directory = os.path.join(os.path.dirname(__file__), "checkpoints", name)
+        os.makedirs(self.directory, exist_ok=True)
+        # Batch composition depends on loader settings outside the palette configuration
+        identity = [config_module.fingerprint(palette_config), int(default_config.batch_size.to_Byte()),
+                    default_config.subrandom, default_config.dataset_path, *map(str, extras)]
+        self.fingerprint = hashlib.sha256(json.dumps(identity).encode()).hexdigest()[:16]
+        self._manifest_path = os.path.join(self.directory, "manifest.json")
+        self.manifest: dict[str, dict[str, str]] = dict()
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path, "r") as manifest:
+                self.manifest = json.load(manifest)
+
+    def _file(self, unit: str) -> str:
+        return os.path.join(self.directory, unit.replace(os.sep, "__"))
+
+    def done(self, unit: str) -> bool:
+        entry = self.manifest.get(unit)
+        return entry is not None and entry["fingerprint"] == self.fingerprint and os.path.exists(self._file(unit))
+
+    def load(self, unit: str) -> typing.Any:
+        with open(self._file(unit), "rb") as file:
+            return pickle.load(file)
+
+    def get(self, unit: str) -> typing.Any | None:
+        """Result of a completed `unit`, or None if it still has to be computed."""
+        return self.load(unit) if self.done(unit) else None
+
+    def put(self, unit: str, value: typing.Any) -> typing.Any:
+        utils.write_atomic(self._file(unit), pickle.dumps(value))
+        self.manifest[unit] = {"fingerprint": self.fingerprint}
+        utils.write_atomic(self._manifest_path, json.dumps(self.manifest, indent=4).encode())
+        return value
+
+    def completed_prefix(self, prefix: str) -> int:
+        """Number of consecutive completed units `{prefix}0`, `{prefix}1`, ..., to skip when resuming."""
+        count = 0
+        while self.done(f"{prefix}{count}"):
+            count += 1
+        return count
+
+    def discard(self, prefix: str):
+        """Forget units starting with `prefix`, e.g. results derived from a recomputed palette."""
+        for unit in [unit for unit in self.manifest if unit.startswith(prefix)]:
+            del self.manifest[unit]
+        utils.write_atomic(self._manifest_path, json.dumps(self.manifest, indent=4).encode())
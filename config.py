@@ -1,4 +1,5 @@
 import dataclasses
+import hashlib
 import json as json_module
 
 import bitmath
@@ -14,6 +15,8 @@ class BatchingKMeansConfig:
     max_iterations: int
     number_of_clusters: int
     parent: "GlobalPaletteConfig | LocalPaletteConfig | None" = None
+    warm_start: bool = False
+    tolerance: float = 0.0
 
     @classmethod
     def from_json(cls, json: typing.Dict[str, typing.Any]) -> typing.Self:
@@ -21,6 +24,8 @@ class BatchingKMeansConfig:
             batch_size=int(json["batch-size"]),
             max_iterations=int(json["max-iterations"]),
             number_of_clusters=int(json["number-of-clusters"]),
+            warm_start=bool(json.get("warm-start", False)),
+            tolerance=float(json.get("tolerance", 0.0)),
         )
 
 
@@ -46,6 +51,15 @@ class GlobalPaletteConfig:
     batching_k_means: BatchingKMeansConfig
     patch_size: int
     parent: "Config | None" = None
+    decode_scale: int = 1
+    lookup_table_bits: int = 0
+    soft_assignment_k: int = 1
+    reservoir_size: int = 0
+    max_patches_per_image: int = 0
+    whitening: bool = False
+    reduction: str = "pca"
+    reduced_dimension: int = 0
+    reduction_sample_size: int = 100_000
 
     @classmethod
     def from_json(cls, json: typing.Dict[str, typing.Any]) -> typing.Self:
@@ -55,8 +69,28 @@ class GlobalPaletteConfig:
             predict_coverage=float(json["predict-coverage"]),
             random=bool(json["random"]),
             batching_k_means=BatchingKMeansConfig.from_json(json["batching-k-means"]),
-            patch_size=int(json["patch-size"])
+            patch_size=int(json["patch-size"]),
+            decode_scale=int(json.get("decode-scale", 1)),
+            lookup_table_bits=int(json.get("lookup-table-bits", 0)),
+            soft_assignment_k=int(json.get("soft-assignment-k", 1)),
+            reservoir_size=int(json.get("reservoir-size", 0)),
+            max_patches_per_image=int(json.get("max-patches-per-image", 0)),
+            whitening=bool(json.get("whitening", False)),
+            reduction=json.get("reduction", "pca"),
+            reduced_dimension=int(json.get("reduced-dimension", 0)),
+            reduction_sample_size=int(json.get("reduction-sample-size", 100_000)),
         )
+        if config.whitening and config.reduced_dimension:
+            raise ValueError("whitening and reduced-dimension are mutually exclusive")
+        if config.reduced_dimension > config.patch_size * config.patch_size * 3:
+            raise ValueError("reduced-dimension must not exceed the patch dimension patch-size * patch-size * 3")
+        if config.lookup_table_bits and config.patch_size != 1:
+            raise ValueError("lookup-table-bits requires patch-size 1")
+        if not 0 <= config.lookup_table_bits <= 8:
+            raise ValueError("lookup-table-bits must be in range [0, 8]")
+        if config.lookup_table_bits and config.soft_assignment_k > 1:
+            # Lookup tables hold only the closest palette entry of every colour
+            raise ValueError("soft-assignment-k > 1 cannot be combined with lookup-table-bits")
         config.batching_k_means.parent = config
         return config
 
@@ -71,6 +105,14 @@ class LocalPaletteConfig:
     patch_size: int
     k_neigh: int
     parent: "Config | None" = None
+    decode_scale: int = 1
+    quantization: str = "none"
+    reservoir_size: int = 0
+    max_patches_per_image: int = 0
+    whitening: bool = False
+    reduction: str = "pca"
+    reduced_dimension: int = 0
+    reduction_sample_size: int = 100_000
 
     @classmethod
     def from_json(cls, json: typing.Dict[str, typing.Any]) -> typing.Self:
@@ -82,11 +124,108 @@ class LocalPaletteConfig:
             batching_k_means=BatchingKMeansConfig.from_json(json["batching-k-means"]),
             patch_size=int(json["patch-size"]),
             k_neigh=int(json["k-neigh"]),
+            decode_scale=int(json.get("decode-scale", 1)),
+            quantization=json.get("quantization", "none"),
+            reservoir_size=int(json.get("reservoir-size", 0)),
+            max_patches_per_image=int(json.get("max-patches-per-image", 0)),
+            whitening=bool(json.get("whitening", False)),
+            reduction=json.get("reduction", "pca"),
+            reduced_dimension=int(json.get("reduced-dimension", 0)),
+            reduction_sample_size=int(json.get("reduction-sample-size", 100_000)),
         )
+        if config.whitening and config.reduced_dimension:
+            raise ValueError("whitening and reduced-dimension are mutually exclusive")
+        if config.reduced_dimension > config.patch_size * config.patch_size * 3:
+            raise ValueError("reduced-dimension must not exceed the patch dimension patch-size * patch-size * 3")
+        if config.quantization not in ("none", "uint8", "int8"):
+            raise ValueError(f"Unknown quantization {config.quantization!r}")
+        if config.quantization == "uint8" and (config.whitening or config.reduced_dimension):
+            # Transformed patches are signed, uint8 would clip them
+            raise ValueError("uint8 quantization requires untransformed patches, use int8 with "
+                             "whitening or reduced-dimension")
         config.batching_k_means.parent = config
         return config
 
 
+@dataclasses.dataclass
+class EnsembleMemberConfig:
+    method: int
+    palette: GlobalPaletteConfig | LocalPaletteConfig
+    artifacts_directory: str
+    weight: float = 1.0
+
+    @classmethod
+    def from_json(cls, json: typing.Dict[str, typing.Any]) -> typing.Self:
+        method = int(json["method"])
+        if method == 1:
+            palette = GlobalPaletteConfig.from_json(json["palette"])
+        elif method == 2:
+            palette = LocalPaletteConfig.from_json(json["palette"])
+        else:
+            raise ValueError(f"Unknown ensemble member method {method}, expected 1 or 2")
+        return cls(
+            method=method,
+            palette=palette,
+            artifacts_directory=json["artifacts-directory"],
+            weight=float(json.get("weight", 1.0)),
+        )
+
+
+@dataclasses.dataclass
+class CascadeConfig:
+    coarse_target: str
+    top_k: int
+    min_share: float = 0.0
+
+    @classmethod
+    def from_json(cls, json: typing.Dict[str, typing.Any]) -> typing.Self:
+        return cls(
+            coarse_target=json["coarse-target"].upper(),
+            top_k=int(json["top-k"]),
+            min_share=float(json.get("min-share", 0.0)),
+        )
+
+
+@dataclasses.dataclass
+class MemoryConfig:
+    budget: bitmath.Bitmath
+    patch_buffer: bitmath.Bitmath
+    search_chunk: bitmath.Bitmath
+    sample_interval: float = 0.1
+
+    @classmethod
+    def from_json(cls, json: typing.Dict[str, typing.Any]) -> typing.Self:
+        return cls(
+            budget=bitmath.parse_string(json["budget"]),
+            patch_buffer=bitmath.parse_string(json.get("patch-buffer", "1 GiB")),
+            search_chunk=bitmath.parse_string(json.get("search-chunk", "64 MiB")),
+            sample_interval=float(json.get("sample-interval", 0.1)),
+        )
+
+    @classmethod
+    def unlimited(cls) -> typing.Self:
+        return cls(
+            budget=bitmath.Byte(2 ** 63 - 1),
+            patch_buffer=bitmath.GiB(1),
+            search_chunk=bitmath.MiB(64),
+        )
+
+
+@dataclasses.dataclass
+class PaletteImageConfig:
+    enabled: bool = True
+    cell_size: int = 32
+    grid: int = 1
+
+    @classmethod
+    def from_json(cls, json: typing.Dict[str, typing.Any]) -> typing.Self:
+        return cls(
+            enabled=bool(json.get("enabled", True)),
+            cell_size=int(json.get("cell-size", 32)),
+            grid=int(json.get("grid", 1)),
+        )
+
+
 @dataclasses.dataclass
 class Config:
     subrandom: bool
@@ -97,6 +236,11 @@ class Config:
     local_palette: LocalPaletteConfig
     random_seed: int
     hdf5_storage: HDF5StorageConfig | None = None
+    ensemble: list[EnsembleMemberConfig] = dataclasses.field(default_factory=list)
+    metadata_path: str = "./dataset-metadata.npz"
+    cascade: CascadeConfig | None = None
+    memory: MemoryConfig = dataclasses.field(default_factory=MemoryConfig.unlimited)
+    palette_images: PaletteImageConfig = dataclasses.field(default_factory=PaletteImageConfig)
 
     @classmethod
     def from_json(cls, json: typing.Dict[str, typing.Any]) -> typing.Self:
@@ -107,12 +251,22 @@ class Config:
             batch_size=bitmath.parse_string(json["loader"]["batch-size"]),
             global_palette=GlobalPaletteConfig.from_json(json["global-palette"]),
             local_palette=LocalPaletteConfig.from_json(json["local-palette"]),
-            random_seed=int(json["random-seed"])
+            random_seed=int(json["random-seed"]),
+            metadata_path=json["loader"].get("metadata-path", "./dataset-metadata.npz"),
         )
         if json["data-storage"] == "hdf5":
             config.hdf5_storage = HDF5StorageConfig.from_json(json["hdf5"])
+        config.ensemble = [EnsembleMemberConfig.from_json(member) for member in json.get("ensemble", [])]
+        if "cascade" in json:
+            config.cascade = CascadeConfig.from_json(json["cascade"])
+        if "memory" in json:
+            config.memory = MemoryConfig.from_json(json["memory"])
+        if "palette-images" in json:
+            config.palette_images = PaletteImageConfig.from_json(json["palette-images"])
         config.global_palette.parent = config
         config.local_palette.parent = config
+        for member in config.ensemble:
+            member.palette.parent = config
         return config
 
     @classmethod
@@ -121,4 +275,20 @@ class Config:
             return cls.from_json(json_module.load(_))
 
 
+def fingerprint(config: typing.Any) -> str:
+    """Stable hash of a config dataclass, `parent` back references are left out."""
+    def fields(value: typing.Any) -> typing.Any:
+        if dataclasses.is_dataclass(value):
+            return {field.name: fields(getattr(value, field.name))
+                    for field in dataclasses.fields(value) if field.name != "parent"}
+        if isinstance(value, list):
+            return [fields(item) for item in value]
+        if isinstance(value, bitmath.Bitmath):
+            return int(value.to_Byte())
+        return value
+
+    serialized = json_module.dumps(fields(config), sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode()).hexdigest()[:16]
+
+
 default_config = Config.default()
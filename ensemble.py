@@ -0,0 +1,132 @@
+import concurrent.futures
+import os
+import pickle
+
+import numpy as np
+from PIL.Image import Image
+from sklearn.neighbors import KNeighborsClassifier
+
+import match
+import palette
+import quantize
+import utils
+from config import EnsembleMemberConfig
+
+
+class EnsembleMember:
+    """Trained artifacts of one palette configuration loaded from `config.artifacts_directory`."""
+
+    def __init__(self, config: EnsembleMemberConfig):
+        self.config = config
+
+        def load(name: str):
+            with open(os.path.join(config.artifacts_directory, name), "rb") as file:
+                return pickle.load(file)
+
+        prefix = "global" if config.method == 1 else "local"
+        self.transform = None
+        if config.palette.whitening:
+            self.transform = load(f"{prefix}_whitening")
+        elif config.palette.reduced_dimension:
+            self.transform = load(f"{prefix}_projection")
+
+        if config.method == 1:
+            self.global_palette: np.ndarray = load("global_palette")
+            self.class_histograms: dict[str, np.ndarray] = load("class_histograms")
+            self.neighbours = KNeighborsClassifier(n_neighbors=1).fit(
+                self.global_palette, np.arange(self.global_palette.shape[0]))
+            self.lookup_table = None
+            if config.palette.lookup_table_bits:
+                # Stale tables (other palette or bits) are ignored, prediction then falls back to neighbour search
+                self.lookup_table = palette.load_lookup_table(
+                    os.path.join(config.artifacts_directory, "global_palette_lut"), self.global_palette,
+                    config.palette.lookup_table_bits, self.transform)
+        else:
+            self.local_palettes: dict[str, np.ndarray] | None = None
+            self.local_neighbours: dict[str, KNeighborsClassifier] | None = None
+            self.quantized: dict[str, quantize.QuantizedPalette] | None = None
+            if config.palette.quantization == "none":
+                self.local_palettes = load("local_palettes")
+                self.local_neighbours = {
+                    cls: KNeighborsClassifier(n_neighbors=1).fit(cls_palette, np.arange(cls_palette.shape[0]))
+                    for cls, cls_palette in self.local_palettes.items()
+                }
+            elif os.path.exists(os.path.join(config.artifacts_directory, "quantized_palettes")):
+                # Only the quantized form is kept, float palettes and their neighbour indices are not needed
+                self.quantized = load("quantized_palettes")
+            else:
+                self.quantized = {
+                    cls: quantize.quantize_palette(cls_palette, config.palette.quantization)
+                    for cls, cls_palette in load("local_palettes").items()
+                }
+
+    @property
+    def classes(self) -> set[str]:
+        if self.config.method == 1:
+            return set(self.class_histograms)
+        return set(self.quantized if self.quantized is not None else self.local_palettes)
+
+    def scores(self, image: np.ndarray, scale: int) -> dict[str, float]:
+        """Per class scores (lower is better) of an image decoded at draft `scale`."""
+        if self.config.method == 1:
+            histogram, _ = match.match1(image, self.global_palette, self.neighbours, self.lookup_table,
+                                        self.config.palette, scale, self.transform)
+            return match.scores1(histogram, self.class_histograms)
+        if self.quantized is not None:
+            matches = {
+                cls: match.match2(image, None, None, quantized, self.config.palette, scale, self.transform)
+                for cls, quantized in self.quantized.items()
+            }
+        else:
+            matches = {
+                cls: match.match2(image, cls_palette, self.local_neighbours[cls], None, self.config.palette, scale,
+                                  self.transform)
+                for cls, cls_palette in self.local_palettes.items()
+            }
+        return match.scores2(matches)
+
+
+class Ensemble:
+    """Classifier fusing scores of several palette configurations, each image is decoded only once.
+
+    Member scores live on different scales (histogram L1 distance vs. sums of patch distances), so each
+    member's per class scores are min-max normalized to [0, 1] before the weighted sum.
+    """
+
+    def __init__(self, members: list[EnsembleMemberConfig], max_workers: int | None = None):
+        assert len(members) > 0, "ensemble requires at least one member"
+        self.members = [EnsembleMember(member) for member in members]
+        self.classes = sorted(set.intersection(*(member.classes for member in self.members)))
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(self.members))
+
+    def decode(self, image: Image) -> tuple[np.ndarray, int]:
+        """Decode `image` once, at the coarsest draft scale every member allows."""
+        scale = utils.draft(image, *(member.config.palette for member in self.members))
+        return utils.image_array(image), scale
+
+    def scores(self, image: Image) -> dict[str, float]:
+        pixels, scale = self.decode(image)
+        # numpy and sklearn release the GIL in the heavy parts, so threads share the decoded array for free
+        member_scores = self._executor.map(lambda member: member.scores(pixels, scale), self.members)
+
+        fused = dict.fromkeys(self.classes, 0.0)
+        for member, scores in zip(self.members, member_scores):
+            values = np.array([scores[cls] for cls in self.classes], dtype=float)
+            spread = values.max() - values.min()
+            normalized = (values - values.min()) / spread if spread > 0 else np.zeros_like(values)
+            for cls, value in zip(self.classes, normalized):
+                fused[cls] += member.config.weight * value
+        return fused
+
+    def predict(self, image: Image) -> str:
+        fused = self.scores(image)
+        return min(fused, key=fused.get)
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,246 @@
+import hashlib
+import json
+import os
+import pickle
+import time
+import typing
+import uuid
+
+import numpy as np
+import scipy.sparse
+
+import config as config_module
+import memory
+import utils
+from config import default_config
+
+
+def fingerprint(
+        palettes: np.ndarray | dict[str, np.ndarray],
+        palette_config: config_module.GlobalPaletteConfig | config_module.LocalPaletteConfig,
+        transform: utils.PatchTransform | None = None,
+        *extras: typing.Any
+) -> str:
+    """Hash of everything per image features depend on: palette(s), their configuration and patch transform."""
+    digest = hashlib.sha256(config_module.fingerprint(palette_config).encode())
+    for cls, cls_palette in sorted(palettes.items()) if isinstance(palettes, dict) else [("", palettes)]:
+        digest.update(cls.encode())
+        digest.update(np.ascontiguousarray(cls_palette).tobytes())
+    if transform is not None:
+        digest.update(pickle.dumps(transform))
+    for extra in extras:
+        digest.update(str(extra).encode())
+    return digest.hexdigest()[:16]
+
+
+def image_key(path: str) -> str:
+    """Store key of an image, relative to the dataset so it survives moving the dataset."""
+    return os.path.relpath(os.path.normpath(path), os.path.normpath(default_config.dataset_path))
+
+
+class FeatureStore:
+    """Append-only per image features of one palette fingerprint, stored in `features/<name>/<fingerprint>`.
+
+    Features are buffered and flushed as immutable part directories of `.npy` arrays (renamed into place
+    once complete), so a store is never left half written and parts can be memory mapped on load. A store
+    that is not `persistent` keeps its parts in memory only.
+    """
+
+    def __init__(self, name: str, fingerprint: str, flush_rows: int = 4096, persistent: bool = True):
+        self.directory = os.path.join(os.path.dirname(__file__), "features", name, fingerprint) if persistent \
+            else None
+        self.flush_rows = flush_rows
+        self.parts: list[str] = list()
+        self._in_memory: dict[str, dict[str, np.ndarray]] = dict()
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.parts = sorted(part for part in os.listdir(self.directory) if part.startswith("part-")
+                                and not part.endswith(".tmp"))
+        # Image key -> (part, row within part)
+        self.rows: dict[str, tuple[int, int]] = dict()
+        for part_index, part in enumerate(self.parts):
+            for row, key in enumerate(self._load(part, "paths")):
+                self.rows[str(key)] = (part_index, row)
+        self._pending_keys: list[str] = list()
+
+    def __contains__(self, path: str) -> bool:
+        return image_key(path) in self.rows
+
+    def missing(self, path: str, *_) -> bool:
+        """`loader.ImageIterator` admit hook: decode only images without cached features."""
+        return path not in self
+
+    def _write_part(self, arrays: dict[str, np.ndarray]):
+        part = f"part-{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        if self.directory is None:
+            self._in_memory[part] = arrays
+        else:
+            temporary = os.path.join(self.directory, f"{part}.tmp")
+            os.makedirs(temporary)
+            for array_name, array in arrays.items():
+                np.save(os.path.join(temporary, f"{array_name}.npy"), array)
+            os.replace(temporary, os.path.join(self.directory, part))
+        for row, key in enumerate(self._pending_keys):
+            self.rows[key] = (len(self.parts), row)
+        self.parts.append(part)
+        self._pending_keys = list()
+
+    def _load(self, part: str, array_name: str, mmap: bool = False) -> np.ndarray:
+        if self.directory is None:
+            return self._in_memory[part][array_name]
+        return np.load(os.path.join(self.directory, part, f"{array_name}.npy"), mmap_mode="r" if mmap else None)
+
+    def _locate(self, paths: list[str]) -> np.ndarray:
+        """(part, row) of every path, all of them must be stored."""
+        return np.array([self.rows[image_key(path)] for path in paths], dtype=np.intp).reshape(-1, 2)
+
+
+class HistogramStore(FeatureStore):
+    """`match.match1` histograms and patch counts per image, one sparse matrix per part."""
+
+    def __init__(self, name: str, fingerprint: str, flush_rows: int = 4096, persistent: bool = True):
+        super().__init__(name, fingerprint, flush_rows, persistent)
+        self._pending: list[scipy.sparse.csr_matrix] = list()
+        self._pending_counts: list[np.ndarray] = list()
+        # Part index -> (histograms, counts) of parts loaded or flushed so far, parts are immutable
+        self._loaded: dict[int, tuple[scipy.sparse.csr_matrix, np.ndarray]] = dict()
+
+    def add(self, paths: list[str], histograms: np.ndarray | scipy.sparse.spmatrix, counts: np.ndarray):
+        self._pending_keys.extend(map(image_key, paths))
+        self._pending.append(scipy.sparse.csr_matrix(histograms))
+        self._pending_counts.append(np.asarray(counts, dtype=np.int64))
+        if len(self._pending_keys) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._pending_keys:
+            return
+        histograms = scipy.sparse.vstack(self._pending, format="csr")
+        counts = np.concatenate(self._pending_counts)
+        self._write_part({
+            "paths": np.array(self._pending_keys, dtype=str),
+            "counts": counts,
+            "data": histograms.data,
+            "indices": histograms.indices,
+            "indptr": histograms.indptr,
+            "shape": np.array(histograms.shape),
+        })
+        # The new part is kept as it is, earlier parts are not loaded again
+        self._loaded[len(self.parts) - 1] = (histograms, counts)
+        self._pending, self._pending_counts = list(), list()
+
+    def _part(self, part_index: int) -> tuple[scipy.sparse.csr_matrix, np.ndarray]:
+        if part_index not in self._loaded:
+            part = self.parts[part_index]
+            self._loaded[part_index] = (
+                scipy.sparse.csr_matrix(
+                    (self._load(part, "data"), self._load(part, "indices"), self._load(part, "indptr")),
+                    shape=tuple(self._load(part, "shape"))),
+                self._load(part, "counts"))
+        return self._loaded[part_index]
+
+    def matrix(self, paths: list[str]) -> tuple[scipy.sparse.csr_matrix, np.ndarray]:
+        """Histograms (one row per path) and patch counts of stored images."""
+        self.flush()
+        located = self._locate(paths)
+        matrices, counts, order = list(), list(), list()
+        # Only parts holding requested images are touched
+        for part_index in np.unique(located[:, 0]):
+            selected = np.flatnonzero(located[:, 0] == part_index)
+            part_histograms, part_counts = self._part(part_index)
+            matrices.append(part_histograms[located[selected, 1]])
+            counts.append(part_counts[located[selected, 1]])
+            order.append(selected)
+        if not matrices:
+            return scipy.sparse.csr_matrix((0, 0)), np.zeros(0, dtype=np.int64)
+        inverse = np.empty(len(paths), dtype=np.intp)
+        inverse[np.concatenate(order)] = np.arange(len(paths))
+        return scipy.sparse.vstack(matrices, format="csr")[inverse], np.concatenate(counts)[inverse]
+
+    def class_histograms(self, groups: dict[str, list[str]]) -> dict[str, np.ndarray]:
+        """Averaged class histograms (summed histograms over summed patch counts)."""
+        class_histograms = dict()
+        for cls, paths in groups.items():
+            histograms, counts = self.matrix(paths)
+            class_histograms[cls] = np.asarray(histograms.sum(axis=0)).ravel() / counts.sum()
+        return class_histograms
+
+
+class TopKStore(FeatureStore):
+    """`match.match2` results per image: distances and indices of the `k` closest entries of every class palette.
+
+    Patches of all images of a part are concatenated into (patches, classes, k) arrays, `offsets` marks
+    where each image's patches start. Parts are memory mapped, so only the rows used are paged in. Pending
+    results are reserved from `memory.governor` and flushed once they reach `flush_bytes`.
+    """
+
+    def __init__(self, name: str, fingerprint: str, classes: list[str], flush_bytes: int = 64 * 1024 * 1024,
+                 persistent: bool = True):
+        super().__init__(name, fingerprint, persistent=persistent)
+        if self.directory is not None:
+            classes_path = os.path.join(self.directory, "classes.json")
+            if os.path.exists(classes_path):
+                with open(classes_path, "r") as classes_file:
+                    assert json.load(classes_file) == classes, "class order differs from the stored one"
+            else:
+                with open(classes_path, "w") as classes_file:
+                    json.dump(classes, classes_file)
+        self.classes = classes
+        self.flush_bytes = flush_bytes
+        self._pending: list[tuple[np.ndarray, np.ndarray]] = list()
+        # Sizes reserved for pending results, each released on flush
+        self._reserved: list[int] = list()
+        self._scores: dict[int, np.ndarray] = dict()
+
+    def add(self, path: str, distances: np.ndarray, indices: np.ndarray):
+        """Store one image's (patches, classes, k) distances and palette indices."""
+        distances, indices = distances.astype(np.float32), indices.astype(np.int32)
+        self._reserved.append(memory.governor.acquire("features", distances.nbytes + indices.nbytes))
+        self._pending_keys.append(image_key(path))
+        self._pending.append((distances, indices))
+        if sum(self._reserved) >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self._pending_keys:
+            return
+        self._write_part({
+            "paths": np.array(self._pending_keys, dtype=str),
+            "offsets": np.cumsum([0] + [len(distances) for distances, _ in self._pending]),
+            "distances": np.concatenate([distances for distances, _ in self._pending]),
+            "indices": np.concatenate([indices for _, indices in self._pending]),
+        })
+        for size in self._reserved:
+            memory.governor.release("features", size)
+        self._pending, self._reserved = list(), list()
+
+    def top_k(self, path: str) -> tuple[np.ndarray, np.ndarray]:
+        """Memory mapped (patches, classes, k) distances and indices of a stored image."""
+        part_index, row = self.rows[image_key(path)]
+        part = self.parts[part_index]
+        offsets = self._load(part, "offsets")
+        rows = slice(offsets[row], offsets[row + 1])
+        return self._load(part, "distances", mmap=True)[rows], self._load(part, "indices", mmap=True)[rows]
+
+    def _part_scores(self, part_index: int) -> np.ndarray:
+        """`match.scores2` of every image of a part against every class, (images, classes)."""
+        if part_index not in self._scores:
+            part = self.parts[part_index]
+            offsets = self._load(part, "offsets")
+            patch_sums = self._load(part, "distances", mmap=True).sum(axis=2)
+            scores = np.zeros((len(offsets) - 1, len(self.classes)))
+            nonempty = offsets[:-1] < offsets[1:]
+            if nonempty.any():
+                scores[nonempty] = np.add.reduceat(patch_sums, offsets[:-1][nonempty], axis=0)
+            self._scores[part_index] = scores
+        return self._scores[part_index]
+
+    def scores(self, paths: list[str]) -> np.ndarray:
+        """(images, classes) sums of distances, lower is better; columns follow `classes`."""
+        self.flush()
+        located = self._locate(paths)
+        scores = np.empty((len(paths), len(self.classes)))
+        for part_index in np.unique(located[:, 0]):
+            selected = located[:, 0] == part_index
+            scores[selected] = self._part_scores(part_index)[located[selected, 1]]
+        return scores
@@ -1,22 +1,42 @@
+import concurrent.futures
+import hashlib
+import json
 import os
-from collections.abc import Iterable
+from collections.abc import Callable, Iterable, Sequence
 from typing import Iterator
 
-from config import default_config
+from config import default_config, GlobalPaletteConfig, LocalPaletteConfig
 
 import PIL
 from PIL.Image import Image
 import pandas as pd
 
+import memory
+import metadata
+import utils
 from utils import ClassificationTarget
 
 
 class ImageIterator(Iterable[list[Image]]):
-    def __init__(self, cls: str, feature_file_paths: list[str]):
+    def __init__(
+            self,
+            cls: str,
+            feature_file_paths: list[str],
+            palette_configs: Sequence[GlobalPaletteConfig | LocalPaletteConfig] = (),
+            workers: int | None = None,
+            admit: Callable[[str, tuple[int, int], int], bool] | None = None
+    ):
         self.cls = cls
         self._feature_file_paths = feature_file_paths
         self._dataset_path = default_config.dataset_path
         self._batch_size: int = default_config.batch_size.to_Byte()
+        # When set, images are decoded once at the reduced resolution all their sampling densities allow
+        self._palette_configs = palette_configs
+        self._workers = workers
+        # Called with (path, decoded size, draft scale) before decoding, images it rejects are skipped
+        self.admit = admit
+        # Leading batches yielded empty without decoding, their results are restored from a checkpoint instead
+        self.skip = 0
 
     @staticmethod
     def _insert_text_before_extension(file, text_to_insert):
@@ -30,23 +50,90 @@ class ImageIterator(Iterable[list[Image]]):
         return f"{self._dataset_path}/{splitted}_{image_number}.jpg"
 
 
+    def plan(self, table: pd.DataFrame) -> list[list[str]]:
+        """Split images into byte-budget batches using only the metadata `table` (no image is opened)."""
+        batches: list[list[str]] = [list()]
+        total_pixel_data_size = 0
+        for file in self._feature_file_paths:
+            for subimage in metadata.image_files(file):
+                if subimage not in table.index:
+                    continue
+                row = table.loc[subimage]
+                if self.admit is not None:
+                    scale = utils.draft_scale((row["width"], row["height"]), row["format"], *self._palette_configs)
+                    size = (-(-row["width"] // scale), -(-row["height"] // scale))
+                    if not self.admit(os.path.join(self._dataset_path, subimage), size, scale):
+                        continue
+                pixel_data_size = metadata.decoded_size(row, *self._palette_configs)
+                if total_pixel_data_size + pixel_data_size <= self._batch_size:
+                    total_pixel_data_size += pixel_data_size
+                else:
+                    batches.append(list())
+                    total_pixel_data_size = pixel_data_size
+                batches[-1].append(subimage)
+        return batches
+
+    def _load(self, subimage: str) -> Image:
+        with PIL.Image.open(os.path.join(self._dataset_path, subimage)) as img:
+            if self._palette_configs:
+                utils.draft(img, *self._palette_configs)
+            img.load()
+            return img
+
     def __iter__(self) -> Iterator[list[Image]]:
+        table = metadata.table()
+        if table is not None:
+            # Batches are known up front, so images of a batch are decoded in parallel (PIL releases the GIL)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self._workers) as executor:
+                for index, batch in enumerate(self.plan(table)):
+                    if index < self.skip:
+                        yield list()
+                        continue
+                    batch_size = sum(metadata.decoded_size(table.loc[subimage], *self._palette_configs)
+                                     for subimage in batch)
+                    # Held while decoding only, iterators of several classes may be suspended at once
+                    # (`feature_batches`), reservations held across `yield` would add up per class
+                    with memory.governor.reserve("loader", batch_size):
+                        images = list(executor.map(self._load, batch))
+                    yield images
+            return
+
+        # Decoding happens inside `next`, a batch never grows beyond the batch size
+        batches = self._iter_lazy()
+        while True:
+            with memory.governor.reserve("loader", self._batch_size):
+                images = next(batches, None)
+            if images is None:
+                return
+            yield images
+
+    def _iter_lazy(self) -> Iterator[list[Image]]:
         accumulated_images: list[Image] = list()
         total_pixel_data_size = 0
+        batch_index = 0
         for file in self._feature_file_paths:
             image_path = os.path.join(self._dataset_path, file)
             for subimage in (map(lambda x : self.extrapolate(file, x),
                                  range(1, 5) if default_config.subrandom else [image_path])):
                 try:
                     with PIL.Image.open(subimage) as img:
+                        if self._palette_configs:
+                            # Draft changes img.size, so the byte budget accounts for decoded (not stored) size
+                            utils.draft(img, *self._palette_configs)
+                        if self.admit is not None and not self.admit(subimage, img.size,
+                                                                     img.info.get("decode-scale", 1)):
+                            continue
                         pixel_data_size = img.size[0] * img.size[1] * len(img.getbands())
 
                         if total_pixel_data_size + pixel_data_size <= self._batch_size:
                             total_pixel_data_size += pixel_data_size
                         else:
                             yield accumulated_images
+                            batch_index += 1
                             total_pixel_data_size = pixel_data_size
                             accumulated_images = list()
+                        if batch_index < self.skip:
+                            continue
                         img.load()
                         accumulated_images.append(img)
                 except FileNotFoundError:
@@ -59,18 +146,41 @@ class BatchLoader(Iterable[ImageIterator]):
 
     _index: dict[ClassificationTarget, dict[str, list[str]]] = dict()
 
-    def __init__(self, target: ClassificationTarget, index=None):
-        if len(BatchLoader._index) == 0:
-            if index is not None:
-                BatchLoader._index = index
-            else:
-                BatchLoader._index = BatchLoader._create_index()
+    def __init__(
+            self,
+            target: ClassificationTarget,
+            index=None,
+            palette_config: GlobalPaletteConfig | LocalPaletteConfig | None = None
+    ):
+        if len(BatchLoader._index) == 0 and index is not None:
+            BatchLoader._index = index
+        BatchLoader.class_paths(target)
         self.target = target
+        self.palette_config = palette_config
 
     def __iter__(self) -> Iterator[ImageIterator]:
         """Returns iterator of iterators that produce per class image batches."""
         for cls, feature_paths in BatchLoader._index[self.target].items():
-            yield ImageIterator(cls, feature_paths)
+            yield ImageIterator(cls, feature_paths, (self.palette_config,) if self.palette_config is not None else ())
+
+    def fingerprint(self) -> str:
+        """Hash of the class paths (label files or `subrandom-index.json`) and the batches the metadata table plans."""
+        digest = hashlib.sha256(json.dumps(BatchLoader.class_paths(self.target), sort_keys=True).encode())
+        table = metadata.table()
+        if table is not None:
+            for image_iterator in self:
+                digest.update(json.dumps(image_iterator.plan(table)).encode())
+        else:
+            # Batches are formed while reading image headers, they only follow from the paths and the batch size
+            digest.update(b"lazy")
+        return digest.hexdigest()[:16]
+
+    @staticmethod
+    def class_paths(target: ClassificationTarget) -> dict[str, list[str]]:
+        """Label file entries of every class of `target`, the index is created on first use."""
+        if len(BatchLoader._index) == 0:
+            BatchLoader._index = BatchLoader._create_index()
+        return BatchLoader._index[target]
 
     @staticmethod
     def _cls_encoding(target: ClassificationTarget) -> dict[int, str]:
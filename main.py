@@ -7,17 +7,24 @@ import os
 import PIL
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 from PIL.Image import Image
 from sklearn.neighbors import KNeighborsClassifier
 
+import cascade
+import checkpoint
+import ensemble
+import features
 import loader
 import match
+import memory
 import palette
+import quantize
 import utils
 import config
 
 from config import default_config
+from reduction import fit_projection
+from whitening import fit_whitening
 
 from typing import Iterator
 
@@ -29,10 +36,14 @@ else:
     from tqdm import tqdm
 
 
-def feature_batches(features_iterator: loader.BatchLoader) -> Iterator[list[Image]]:
+def feature_batches(features_iterator: loader.BatchLoader, skip: int = 0) -> Iterator[list[Image]]:
+    """Batches of images of all classes, the first `skip` ones are yielded empty without decoding any image."""
+    class_iterators = list(features_iterator)
+    for class_iterator in class_iterators:
+        class_iterator.skip = skip
     samples = list()
     samples.clear()
-    for features in tqdm(itertools.zip_longest(*features_iterator), desc="class batches"):
+    for features in tqdm(itertools.zip_longest(*class_iterators), desc="class batches"):
         samples.clear()
         samples.extend(itertools.chain.from_iterable(
             (image for image in image_batch) for image_batch in features if image_batch is not None)
@@ -49,74 +60,167 @@ def predict1(
         global_palette: np.ndarray,
         class_histograms: dict[Class, np.ndarray],
         neighbours: KNeighborsClassifier,
+        lookup_table: np.ndarray | None = None,
+        transform: utils.PatchTransform | None = None,
 ) -> Class:
-    (histogram, _) = match.match1(image, global_palette, neighbours)
-    difference = dict()
-    for cls, cls_histogram in class_histograms.items():
-        difference[cls] = abs(cls_histogram - histogram).sum()
+    (histogram, _) = match.match1(image, global_palette, neighbours, lookup_table, transform=transform)
+    difference = match.scores1(histogram, class_histograms)
 
     return min(difference, key=difference.get)
 
 
+def artifact_name(name: str, target: utils.ClassificationTarget) -> str:
+    """Artifacts of targets other than `TARGET` (e.g. coarse cascade palettes) are suffixed with the target."""
+    return name if target == TARGET else f"{name}_{target.name.lower()}"
+
+
+def load_or_fit_transform(
+        prefix: str,
+        batch_loader: loader.BatchLoader,
+        palette_config: config.GlobalPaletteConfig | config.LocalPaletteConfig,
+        pickling: bool,
+        loading: bool,
+        training_checkpoint: checkpoint.Checkpoint | None = None
+) -> utils.PatchTransform | None:
+    """Whitening or projection shared by training and prediction of `palette_config`, fitted once and stored.
+
+    Fitting samples patches randomly, a resumed run reuses the transform of `training_checkpoint` so that
+    checkpointed palettes stay in the space they were trained in.
+    """
+    if palette_config.whitening:
+        name, fit = f"{prefix}_whitening", fit_whitening
+    elif palette_config.reduced_dimension:
+        name, fit = f"{prefix}_projection", fit_projection
+    else:
+        return None
+    transform_path = os.path.join(os.path.dirname(__file__), name)
+    if loading:
+        return pickle.load(open(transform_path, "rb"))
+    transform = training_checkpoint.get("transform") if training_checkpoint is not None else None
+    if transform is None:
+        transform = fit(batch_loader, palette_config)
+        if training_checkpoint is not None:
+            training_checkpoint.put("transform", transform)
+    if pickling:
+        pickle.dump(transform, open(transform_path, "wb"))
+    return transform
+
+
 def method1(batch_loader: loader.BatchLoader, loader_params: list, pickling: bool = True, loading: bool = False):
     # CREATING GLOBAL PALETTE
     palettes = list()
-    palettes_dir = None
-    histograms_dir = None
-    if pickling:
-        palettes_dir = os.path.join(os.path.dirname(__file__), "palettes")
-        histograms_dir = os.path.join(os.path.dirname(__file__), "histograms")
-        if not os.path.exists(palettes_dir):
-            os.makedirs(palettes_dir, exist_ok=True)
-        if not os.path.exists(palettes_dir):
-            os.makedirs(histograms_dir, exist_ok=True)
+    # Completed units of an interrupted run are reused, see `checkpoint.Checkpoint`
+    training_checkpoint = None
+    if pickling and not loading:
+        training_checkpoint = checkpoint.Checkpoint(artifact_name("method1", batch_loader.target),
+                                                    default_config.global_palette, batch_loader.target.name,
+                                                    batch_loader.fingerprint())
+
+    transform = load_or_fit_transform("global", batch_loader, default_config.global_palette,
+                                      pickling, loading, training_checkpoint)
 
     if not loading:
-        for idx, image_batch in enumerate(tqdm(feature_batches(batch_loader), desc=" features")):
-            curr_palette = palette.generate_palette(image_batch, default_config.global_palette, verbose=True)
-            palettes.append(curr_palette)
-            print(f"Generated palette nr {idx}")
+        # Warm start every k-means from the palette of the previous run
+        previous_palette = None
+        previous_palette_path = os.path.join(os.path.dirname(__file__), "global_palette")
+        if default_config.global_palette.batching_k_means.warm_start and os.path.exists(previous_palette_path):
+            previous_palette = pickle.load(open(previous_palette_path, "rb"))
+
+        global_palette = training_checkpoint.get("global_palette") if training_checkpoint is not None else None
+        if global_palette is not None:
+            print("Resuming from checkpointed global palette")
+        elif default_config.global_palette.reservoir_size:
+            # Stratified: equally sized uniform reservoir sample of every class
+            patches = np.vstack([palette.reservoir_sample(feature_batch_iterator, default_config.global_palette)
+                                 for feature_batch_iterator in batch_loader])
+            if transform is not None:
+                patches = transform.transform(patches)
+            global_palette = palette.fit_palette(patches, default_config.global_palette, verbose=True,
+                                                 init=previous_palette)
+            del patches
+        else:
+            completed = training_checkpoint.completed_prefix("palette") if training_checkpoint is not None else 0
+            for idx, image_batch in enumerate(tqdm(feature_batches(batch_loader, skip=completed), desc=" features")):
+                if idx < completed:
+                    palettes.append(training_checkpoint.load(f"palette{idx}"))
+                    continue
+                curr_palette = palette.generate_palette(image_batch, default_config.global_palette, verbose=True,
+                                                        transform=transform, init=previous_palette)
+                palettes.append(curr_palette)
+                print(f"Generated palette nr {idx}")
 
-            if pickling:
-                assert palettes_dir is not None
-                pickle.dump(curr_palette, open(os.path.join(palettes_dir, f"palette{idx}"), "wb"))
+                if training_checkpoint is not None:
+                    training_checkpoint.put(f"palette{idx}", curr_palette)
 
-        global_palette = palette.merge_palettes(palettes, default_config.global_palette)
+            global_palette = palette.merge_palettes(palettes, default_config.global_palette, init=previous_palette)
+        if training_checkpoint is not None and not training_checkpoint.done("global_palette"):
+            # Histograms of a previous palette no longer apply
+            training_checkpoint.discard("histogram/")
+            training_checkpoint.put("global_palette", global_palette)
+        reconstructed_palette = transform.inverse_transform(global_palette) if transform is not None else global_palette
         if pickling:
             pickle.dump(global_palette, open(os.path.join(os.path.dirname(__file__), "global_palette"), "wb"))
-        fig = palette.plot_palette(global_palette, default_config.global_palette).savefig(
-            os.path.join(os.path.dirname(__file__), f"global_palette.png"))
-        plt.close()
+            if transform is not None:
+                # Pixel space palette, the transformed one is only meaningful together with the transform
+                pickle.dump(reconstructed_palette,
+                            open(os.path.join(os.path.dirname(__file__), "global_palette_reconstructed"), "wb"))
+        palette.save_palette_image(reconstructed_palette, default_config.global_palette,
+                                   os.path.join(os.path.dirname(__file__), f"global_palette.png"))
     else:
         global_palette = pickle.load(open(os.path.join(os.path.dirname(__file__), "global_palette"), "rb"))
 
     # CALCULATING AVERAGE CLASS HISTOGRAMS
     neighbours = KNeighborsClassifier(n_neighbors=1).fit(global_palette, np.arange(global_palette.shape[0]))
 
+    lookup_table = None
+    if default_config.global_palette.lookup_table_bits:
+        bits = default_config.global_palette.lookup_table_bits
+        lookup_table_path = os.path.join(os.path.dirname(__file__), "global_palette_lut")
+        # A stored table is only reused if it was built from this palette, bits and transform
+        lookup_table = palette.load_lookup_table(lookup_table_path, global_palette, bits, transform)
+        if lookup_table is None:
+            lookup_table = palette.build_lookup_table(global_palette, bits, transform)
+            if pickling:
+                palette.store_lookup_table(lookup_table_path, lookup_table, global_palette, bits, transform)
+
+    # Histograms of every matched image, reused by later runs with the same palette (kept in memory otherwise)
+    feature_store = features.HistogramStore(
+        artifact_name("method1", batch_loader.target),
+        features.fingerprint(global_palette, default_config.global_palette, transform, lookup_table is not None),
+        persistent=pickling)
+
     if not loading:
         class_histograms = dict()
         for feature_batch_iterator in loader.BatchLoader(*loader_params):
-            avg_histogram = np.zeros((default_config.global_palette.size,))
-            total_patch_count = 0
-
-            # Generate averaged class histogram
+            if training_checkpoint is not None and training_checkpoint.done(f"histogram/{feature_batch_iterator.cls}"):
+                class_histograms[feature_batch_iterator.cls] = training_checkpoint.load(
+                    f"histogram/{feature_batch_iterator.cls}")
+                continue
+            class_paths = list()
+
+            def admit(path: str, *_) -> bool:
+                class_paths.append(path)
+                return feature_store.missing(path)
+
+            # Only images without stored histograms are decoded and matched
+            feature_batch_iterator.admit = admit
             for image_batch in tqdm(feature_batch_iterator, desc=" feature"):
-                for image in tqdm(image_batch, desc=" batch"):
-                    # TODO: image -> np.ndarray should have it's own function,
-                    #  and in general structure of this code duplicates -- fix it.
-                    (histogram, patches_count) = match.match1(
-                        # TODO: image dimensions are hard coded here
-                        image,
-                        global_palette,
-                        neighbours
-                    )
-                    total_patch_count += patches_count
-                    avg_histogram += histogram
-            avg_histogram /= total_patch_count
+                if len(image_batch) == 0:
+                    continue
+                (histograms, patches_counts) = match.match1_batch(
+                    image_batch,
+                    global_palette,
+                    neighbours,
+                    lookup_table,
+                    sparse=True,
+                    transform=transform
+                )
+                feature_store.add([image.filename for image in image_batch], histograms, patches_counts)
+            avg_histogram = feature_store.class_histograms({feature_batch_iterator.cls: class_paths})[
+                feature_batch_iterator.cls]
             class_histograms[feature_batch_iterator.cls] = avg_histogram
-            if pickling:
-                assert histograms_dir is not None
-                pickle.dump(avg_histogram, open(os.path.join(histograms_dir, f"{feature_batch_iterator.cls}"), "wb"))
+            if training_checkpoint is not None:
+                training_checkpoint.put(f"histogram/{feature_batch_iterator.cls}", avg_histogram)
 
         if pickling:
             pickle.dump(class_histograms, open(os.path.join(os.path.dirname(__file__), "class_histograms"), "wb"))
@@ -129,79 +233,173 @@ def method1(batch_loader: loader.BatchLoader, loader_params: list, pickling: boo
         os.path.join(default_config.dataset_labels_path, f"{batch_loader.target.name.lower()}_val.csv"),
         names=["path", "encoded_cls"])
 
-    correct, all_entries = 0, 0
     class_encoding = batch_loader._cls_encoding(TARGET)
-    for _, entry in val_entries.iterrows():
+    val_paths = [os.path.join(default_config.dataset_path, path) for path in val_entries["path"]]
+    for path in tqdm([path for path in val_paths if feature_store.missing(path)], desc="validation features"):
         try:
-            with PIL.Image.open(os.path.join(default_config.dataset_path, entry['path'])) as sample:
-                prediction = predict1(sample, global_palette, class_histograms, neighbours)
-                target = class_encoding[entry["encoded_cls"]]
-                print(f"target: {target}, prediction: {prediction}")
-                correct += (prediction == target)
-                all_entries += 1
+            with PIL.Image.open(path) as sample:
+                (histogram, patch_count) = match.match1(sample, global_palette, neighbours, lookup_table,
+                                                        transform=transform)
+                feature_store.add([path], histogram[None, :], np.array([patch_count]))
         except FileNotFoundError:
             continue
-    print(correct / all_entries)
+    feature_store.flush()
+
+    # Scoring all stored validation histograms at once, no image is matched again
+    found = np.array([path in feature_store for path in val_paths], dtype=bool)
+    classes, scores = match.scores1_batch(
+        feature_store.matrix([path for path, exists in zip(val_paths, found) if exists])[0], class_histograms)
+    predictions = np.array(classes)[scores.argmin(axis=1)]
+    targets = val_entries["encoded_cls"][found].map(class_encoding).to_numpy()
+    print((predictions == targets).mean())
+
+
+def class_matches(
+        image: Image | np.ndarray,
+        local_palettes: dict[Class, np.ndarray] | None,
+        neighbours: dict[Class, KNeighborsClassifier] | None,
+        quantized_palettes: dict[Class, quantize.QuantizedPalette] | None = None,
+        transform: utils.PatchTransform | None = None,
+        scale: int = 1,
+) -> dict[Class, tuple[np.ndarray, np.ndarray]]:
+    """`match.match2` against every class palette, quantized ones replace float palettes and neighbours."""
+    if quantized_palettes is not None:
+        return {cls: match.match2(image, None, None, quantized, scale=scale, transform=transform)
+                for cls, quantized in quantized_palettes.items()}
+    return {cls: match.match2(image, cls_palette, neighbours[cls], scale=scale, transform=transform)
+            for cls, cls_palette in local_palettes.items()}
 
 
 def predict2(
         image: Image,
-        local_palettes: dict[Class, np.ndarray],
-        neighbours: dict[Class, KNeighborsClassifier],
+        local_palettes: dict[Class, np.ndarray] | None,
+        neighbours: dict[Class, KNeighborsClassifier] | None,
+        quantized_palettes: dict[Class, quantize.QuantizedPalette] | None = None,
+        transform: utils.PatchTransform | None = None,
 ):
-    matches = dict()
+    sums = match.scores2(class_matches(image, local_palettes, neighbours, quantized_palettes, transform))
+    return min(sums, key=sums.get)
 
-    for cls, cls_palette in local_palettes.items():
-        cls_match = match.match2(image, cls_palette, neighbours[cls])
-        matches[cls] = cls_match
 
-    # TODO: how to pick closest class? minimum sum of distances for now
-    sums = {cls: np.sum(matches[cls][0]) for cls in matches.keys()}
-    return min(sums, key=sums.get)
+def match2_features(
+        image: Image,
+        local_palettes: dict[Class, np.ndarray] | None,
+        neighbours: dict[Class, KNeighborsClassifier] | None,
+        quantized_palettes: dict[Class, quantize.QuantizedPalette] | None = None,
+        transform: utils.PatchTransform | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """(patches, classes, k) distances and indices of one decoded patch sample against every class palette."""
+    pixels, scale = utils.decode(image, default_config.local_palette)
+    matches = list(class_matches(pixels, local_palettes, neighbours, quantized_palettes, transform, scale).values())
+    distances = np.stack([cls_distances for cls_distances, _ in matches], axis=1)
+    indices = np.stack([cls_indices for _, cls_indices in matches], axis=1)
+    return distances, indices
 
 
 def method2(batch_loader: loader.BatchLoader, pickling: bool = True, loading: bool = False):
     # GENERATING LOCAL (CLASS) PALETTES
     local_palettes = dict()
-    neighbours = dict()
+    training_checkpoint = None
     if pickling:
-        palettes_dir = os.path.join(os.path.dirname(__file__), "loc_palettes")
+        palettes_dir = os.path.join(os.path.dirname(__file__), artifact_name("loc_palettes", batch_loader.target))
         if not os.path.exists(palettes_dir):
             os.makedirs(palettes_dir, exist_ok=True)
+        if not loading:
+            training_checkpoint = checkpoint.Checkpoint(artifact_name("method2", batch_loader.target),
+                                                        default_config.local_palette, batch_loader.target.name,
+                                                        batch_loader.fingerprint())
+
+    transform = load_or_fit_transform(artifact_name("local", batch_loader.target), batch_loader,
+                                      default_config.local_palette, pickling, loading, training_checkpoint)
+    local_palettes_path = os.path.join(os.path.dirname(__file__), artifact_name("local_palettes", batch_loader.target))
+
+    quantization = default_config.local_palette.quantization
+    quantized_palettes_path = os.path.join(os.path.dirname(__file__),
+                                           artifact_name("quantized_palettes", batch_loader.target))
+    quantized_palettes = None
 
     if loading:
-        local_palettes = pickle.load(open(os.path.join(os.path.dirname(__file__), "local_palettes"), "rb"))
+        if quantization != "none" and os.path.exists(quantized_palettes_path):
+            # Quantized palettes replace the float palettes and their neighbour indices entirely
+            quantized_palettes = pickle.load(open(quantized_palettes_path, "rb"))
+            local_palettes = None
+        else:
+            local_palettes = pickle.load(open(local_palettes_path, "rb"))
     else:
-        palette_images_dir = os.path.join(os.path.dirname(__file__), "loc_palette_images")
+        palette_images_dir = os.path.join(os.path.dirname(__file__),
+                                          artifact_name("loc_palette_images", batch_loader.target))
         if not os.path.exists(palette_images_dir):
             os.makedirs(palette_images_dir, exist_ok=True)
 
-    for feature_batch_iterator in batch_loader:
+    for feature_batch_iterator in (batch_loader if not loading else ()):
         cls = feature_batch_iterator.cls
         # if cls != "Vincent_van_Gogh" and cls != "Pablo_Picasso":
         #     continue
 
         print(f'\n{cls}')
-        if not loading:
+        previous_palette = None
+        previous_palette_path = os.path.join(os.path.dirname(__file__),
+                                             artifact_name("loc_palettes", batch_loader.target), f"{cls}")
+        if default_config.local_palette.batching_k_means.warm_start and os.path.exists(previous_palette_path):
+            previous_palette = pickle.load(open(previous_palette_path, "rb"))
+
+        if training_checkpoint is not None and training_checkpoint.done(f"local_palette/{cls}"):
+            local_palette = training_checkpoint.load(f"local_palette/{cls}")
+            print("Resuming from checkpointed local palette")
+        elif default_config.local_palette.reservoir_size:
+            local_palette = palette.generate_reservoir_palette(feature_batch_iterator, default_config.local_palette,
+                                                               transform=transform, init=previous_palette)
+        else:
             palettes = list()
+            completed = 0
+            if training_checkpoint is not None:
+                completed = training_checkpoint.completed_prefix(f"palette/{cls}/")
+                feature_batch_iterator.skip = completed
             for idx, image_batch in enumerate(tqdm(feature_batch_iterator, desc=" feature")):
-                palettes.append(palette.generate_palette(image_batch, default_config.local_palette))
+                if idx < completed:
+                    palettes.append(training_checkpoint.load(f"palette/{cls}/{idx}"))
+                    continue
+                palettes.append(palette.generate_palette(image_batch, default_config.local_palette,
+                                                         transform=transform, init=previous_palette))
                 print(f"Generated palette nr {idx}")
-
-            local_palette = palette.merge_palettes(palettes, default_config.local_palette)
-            local_palettes[cls] = local_palette
-
-            fig = palette.plot_palette(local_palettes[cls], default_config.local_palette).savefig(
-                os.path.join(palette_images_dir, f"{cls}.png"))
-            plt.close()
-        neighbours[cls] = KNeighborsClassifier(n_neighbors=1).fit(local_palettes[cls],
-                                                                  np.arange(local_palettes[cls].shape[0]))
-
+                if training_checkpoint is not None:
+                    training_checkpoint.put(f"palette/{cls}/{idx}", palettes[-1])
+
+            local_palette = palette.merge_palettes(palettes, default_config.local_palette, init=previous_palette)
+        if training_checkpoint is not None and not training_checkpoint.done(f"local_palette/{cls}"):
+            training_checkpoint.put(f"local_palette/{cls}", local_palette)
+        local_palettes[cls] = local_palette
+
+        palette.save_palette_image(
+            transform.inverse_transform(local_palettes[cls]) if transform is not None else local_palettes[cls],
+            default_config.local_palette,
+            os.path.join(palette_images_dir, f"{cls}.png"))
         if pickling:
             pickle.dump(local_palettes[cls], open(os.path.join(palettes_dir, f"{cls}"), "wb"))
 
-    if pickling:
-        pickle.dump(local_palettes, open(os.path.join(os.path.dirname(__file__), "local_palettes"), "wb"))
+    if pickling and not loading:
+        pickle.dump(local_palettes, open(local_palettes_path, "wb"))
+        if transform is not None:
+            # Pixel space palettes, the transformed ones are only meaningful together with the transform
+            pickle.dump({cls: transform.inverse_transform(cls_palette) for cls, cls_palette in local_palettes.items()},
+                        open(os.path.join(os.path.dirname(__file__),
+                                          artifact_name("local_palettes_reconstructed", batch_loader.target)), "wb"))
+
+    if quantization != "none" and quantized_palettes is None:
+        quantized_palettes = {
+            cls: quantize.quantize_palette(cls_palette, quantization) for cls, cls_palette in local_palettes.items()
+        }
+        float_bytes = sum(cls_palette.nbytes for cls_palette in local_palettes.values())
+        quantized_bytes = sum(quantized.values.nbytes for quantized in quantized_palettes.values())
+        print(f"Quantized palettes: {float_bytes / 2 ** 20:.1f} MiB -> {quantized_bytes / 2 ** 20:.1f} MiB")
+        if pickling:
+            pickle.dump(quantized_palettes, open(quantized_palettes_path, "wb"))
+
+    # Neighbour indices are only needed by the float path
+    neighbours = None
+    if local_palettes is not None:
+        neighbours = {cls: KNeighborsClassifier(n_neighbors=1).fit(cls_palette, np.arange(cls_palette.shape[0]))
+                      for cls, cls_palette in local_palettes.items()}
 
     # VALIDATION
     val_entries = pd.read_csv(
@@ -211,20 +409,103 @@ def method2(batch_loader: loader.BatchLoader, pickling: bool = True, loading: bo
     # only Van Gogh and Picasso
     # val_entries = val_entries[(val_entries["encoded_cls"] == 15) | (val_entries["encoded_cls"] == 22)]
 
+    class_encoding = batch_loader._cls_encoding(batch_loader.target)
+    # Fixed subset, so that stored features of earlier runs are reused
+    val_entries = val_entries.sample(frac=0.1, random_state=default_config.random_seed)
+    val_paths = [os.path.join(default_config.dataset_path, path) for path in val_entries["path"]]
+    targets = val_entries["encoded_cls"].map(class_encoding).to_numpy()
+
+    def accuracy(quantized: dict[Class, quantize.QuantizedPalette] | None) -> float:
+        if quantized is not None:
+            palettes_fingerprint = features.fingerprint(
+                {cls: cls_quantized.values for cls, cls_quantized in quantized.items()},
+                default_config.local_palette, transform,
+                *((cls_quantized.scale, cls_quantized.offset) for cls_quantized in quantized.values()))
+        else:
+            palettes_fingerprint = features.fingerprint(local_palettes, default_config.local_palette, transform)
+        store = features.TopKStore(artifact_name("method2", batch_loader.target), palettes_fingerprint,
+                                   list(quantized if quantized is not None else local_palettes), persistent=pickling)
+        for path in tqdm([path for path in val_paths if store.missing(path)], desc="validation features"):
+            try:
+                with PIL.Image.open(path) as sample:
+                    store.add(path, *match2_features(sample, local_palettes, neighbours, quantized, transform))
+            except FileNotFoundError:
+                continue
+        store.flush()
+        # Scores of all stored images come from summed cached distances, no image is matched again
+        found = np.array([path in store for path in val_paths], dtype=bool)
+        scores = store.scores([path for path, exists in zip(val_paths, found) if exists])
+        return (np.array(store.classes)[scores.argmin(axis=1)] == targets[found]).mean()
+
+    correct = accuracy(quantized_palettes)
+    if quantized_palettes is not None and local_palettes is not None:
+        # Accuracy of the float path, reported alongside quantized predictions right after training
+        float_correct = accuracy(None)
+        print(f'{correct} (float: {float_correct}, delta: {correct - float_correct:+})')
+    else:
+        print(correct)
+
+
+def ensemble_method(batch_loader: loader.BatchLoader):
+    """Validate the ensemble of palette configurations listed under `ensemble` in the config."""
+    val_entries = pd.read_csv(
+        os.path.join(default_config.dataset_labels_path, f"{batch_loader.target.name.lower()}_val.csv"),
+        names=["path", "encoded_cls"])
+
     correct, all_entries = 0, 0
     class_encoding = batch_loader._cls_encoding(TARGET)
-    for _, entry in val_entries.sample(frac=0.1).iterrows():
+    with ensemble.Ensemble(default_config.ensemble) as classifier:
+        for _, entry in val_entries.iterrows():
+            try:
+                with PIL.Image.open(os.path.join(default_config.dataset_path, entry['path'])) as sample:
+                    prediction = classifier.predict(sample)
+                    target = class_encoding[entry["encoded_cls"]]
+                    correct += (prediction == target)
+                    all_entries += 1
+                    print(f'\r{correct / all_entries}', end="")
+            except FileNotFoundError:
+                continue
+
+
+def cascade_method(batch_loader: loader.BatchLoader):
+    """Validate coarse-to-fine prediction, coarse palettes come from a method2 run on `cascade.coarse-target`."""
+    assert default_config.cascade is not None, "cascade section is missing in the config"
+    coarse_target = utils.ClassificationTarget[default_config.cascade.coarse_target]
+
+    def load(target: utils.ClassificationTarget):
+        local_palettes = pickle.load(
+            open(os.path.join(os.path.dirname(__file__), artifact_name("local_palettes", target)), "rb"))
+        transform = load_or_fit_transform(artifact_name("local", target), batch_loader, default_config.local_palette,
+                                          pickling=False, loading=True)
+        return local_palettes, transform
+
+    coarse_palettes, coarse_transform = load(coarse_target)
+    fine_palettes, fine_transform = load(batch_loader.target)
+    predictor = cascade.CascadePredictor(
+        coarse_palettes, fine_palettes,
+        cascade.class_associations(coarse_target, batch_loader.target, default_config.cascade.min_share),
+        default_config.cascade.top_k,
+        coarse_transform=coarse_transform, fine_transform=fine_transform
+    )
+
+    val_entries = pd.read_csv(
+        os.path.join(default_config.dataset_labels_path, f"{batch_loader.target.name.lower()}_val.csv"),
+        names=["path", "encoded_cls"])
+
+    correct, all_entries, match_count = 0, 0, 0
+    class_encoding = batch_loader._cls_encoding(batch_loader.target)
+    for _, entry in val_entries.iterrows():
         try:
-            with PIL.Image.open(os.path.join("./cut_wikiart/", entry['path'])) as sample:
-                prediction = predict2(sample, local_palettes, neighbours)
+            with PIL.Image.open(os.path.join(default_config.dataset_path, entry['path'])) as sample:
+                prediction = predictor.predict(sample)
                 target = class_encoding[entry["encoded_cls"]]
-                # print(f"target: {target}, prediction: {prediction}")
                 correct += (prediction == target)
                 all_entries += 1
-                print(f'\r{correct / all_entries}', end="")
+                match_count += predictor.last_match_count
+                print(f'\r{correct / all_entries} (matches per image: {match_count / all_entries:.1f} '
+                      f'of {len(fine_palettes)})', end="")
         except FileNotFoundError:
             continue
-    # print(correct / all_entries)
 
 
 def main():
@@ -235,6 +516,14 @@ def main():
                         help="Override path to the dataset labels specified in --config")
     parser.add_argument("--batch-size", nargs=2, type=str,
                         help="Override batch size for the loader specified in --config. Format: <value> <unit> (e.g. 256 MiB)")
+    parser.add_argument("--ensemble", action="store_true",
+                        help="Validate the ensemble of palette configurations from --config instead of method2")
+    parser.add_argument("--cascade", action="store_true",
+                        help="Validate coarse-to-fine cascade prediction (see cascade section of --config)")
+    parser.add_argument("--target", type=str, default=TARGET.name,
+                        help="Classification target of method2, e.g. cascade.coarse-target for the coarse palettes")
+    parser.add_argument("--train", action="store_true",
+                        help="Train method2 palettes for --target instead of loading stored ones")
 
     args = parser.parse_args()
 
@@ -252,15 +541,21 @@ def main():
             for target in deserialized_raw:
                 subrandom_index[utils.ClassificationTarget[target]] = deserialized_raw[target]
 
-    batch_loader = loader.BatchLoader(TARGET, index=subrandom_index)
+    target = utils.ClassificationTarget[args.target.upper()]
+    batch_loader = loader.BatchLoader(target, index=subrandom_index, palette_config=config.default_config.local_palette)
 
     # method1(batch_loader, loader_params, config)
 
-    method2(batch_loader, loading=True)
+    if args.ensemble:
+        ensemble_method(batch_loader)
+    elif args.cascade:
+        cascade_method(batch_loader)
+    else:
+        method2(batch_loader, loading=not args.train)
 
 
 if __name__ == "__main__":
     try:
         main()
     finally:
-        pass
+        print(memory.governor.report())
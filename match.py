@@ -1,36 +1,135 @@
-from utils import get_patches, k_closest, histogram
+import memory
+import quantize
+from quantize import QuantizedPalette
+from utils import get_patches, k_closest, histogram, batch_histograms, lookup_histogram, \
+    PatchTransform, decode
 from sklearn.neighbors import KNeighborsClassifier
 from typing import Tuple
 
 import numpy as np
-from config import default_config
+import scipy.sparse
+from config import default_config, GlobalPaletteConfig, LocalPaletteConfig
 
 from PIL.Image import Image
 
 
+def _decode(
+        image: Image | np.ndarray,
+        config: GlobalPaletteConfig | LocalPaletteConfig,
+        scale: int
+) -> Tuple[np.ndarray, int]:
+    """Decode `image` unless it is already an array (decoded at draft `scale`)."""
+    if isinstance(image, np.ndarray):
+        return image, scale
+    return decode(image, config)
+
+
 def match1(
-        image: Image,
+        image: Image | np.ndarray,
         palette: np.ndarray,
-        neigh: KNeighborsClassifier | None = None
+        neigh: KNeighborsClassifier | None = None,
+        lookup_table: np.ndarray | None = None,
+        config: GlobalPaletteConfig | None = None,
+        scale: int = 1,
+        transform: PatchTransform | None = None
 ) -> Tuple[np.ndarray, int]:
-    """For each patch from `image` find the closest patch from palette and arrange distances into histogram."""
+    """For each patch from `image` find the closest patch from palette and arrange distances into histogram.
 
-    # TODO: this is duplicated in palette
-    image_array = np.asarray(image, dtype='B').reshape(image.height, image.width, len(image.getbands()))
+    With `lookup_table` (1x1 palettes only) every pixel is histogrammed by a table gather instead of knn search.
+    """
+    config = config if config is not None else default_config.global_palette
 
-    patches = get_patches(image_array,default_config.global_palette , default_config.global_palette.predict_coverage)
+    pixels, scale = _decode(image, config, scale)
+    if lookup_table is not None:
+        assert config.patch_size == 1 and config.soft_assignment_k == 1
+        return lookup_histogram(pixels, lookup_table, palette.shape[0]), pixels.shape[0] * pixels.shape[1]
+    patches = get_patches(pixels, config, config.predict_coverage, scale)
+    if transform is not None:
+        patches = transform.transform(patches)
 
-    _, neighbors = k_closest(patches, palette, 1, neigh)
-    return histogram(neighbors, palette.shape[0]), len(patches)
+    distances, neighbors = k_closest(patches, palette, config.soft_assignment_k, neigh)
+    soft = distances if config.soft_assignment_k > 1 else None
+    return histogram(neighbors, palette.shape[0], soft), len(patches)
 
 
-def match2(
-        image: Image,
+def match1_batch(
+        images: list[Image],
         palette: np.ndarray,
-        neigh: KNeighborsClassifier | None = None
+        neigh: KNeighborsClassifier | None = None,
+        lookup_table: np.ndarray | None = None,
+        config: GlobalPaletteConfig | None = None,
+        sparse: bool = False,
+        transform: PatchTransform | None = None
 ) -> Tuple[np.ndarray, np.ndarray]:
-    # TODO: this is duplicated in palette
-    image_array = np.asarray(image, dtype='B').reshape(image.height, image.width, len(image.getbands()))
+    """`match1` for a whole batch: one neighbour search over all patches, returns (histograms, patch counts)."""
+    config = config if config is not None else default_config.global_palette
+
+    decoded = [_decode(image, config, 1) for image in images]
+    if lookup_table is not None:
+        assert config.patch_size == 1 and config.soft_assignment_k == 1
+        histograms = np.vstack([lookup_histogram(pixels, lookup_table, palette.shape[0]) for pixels, _ in decoded])
+        return histograms, np.array([pixels.shape[0] * pixels.shape[1] for pixels, _ in decoded])
+
+    patches = [get_patches(pixels, config, config.predict_coverage, scale) for pixels, scale in decoded]
+    counts = np.array([len(image_patches) for image_patches in patches])
+    patches = np.vstack(patches)
+    if transform is not None:
+        patches = transform.transform(patches)
+    distances, neighbors = k_closest(patches, palette, config.soft_assignment_k, neigh)
+    splits = np.cumsum(counts)[:-1]
+    soft = np.split(distances, splits) if config.soft_assignment_k > 1 else None
+    return batch_histograms(np.split(neighbors, splits), palette.shape[0], soft, sparse), counts
+
+
+def match2(
+        image: Image | np.ndarray,
+        palette: np.ndarray | None,
+        neigh: KNeighborsClassifier | None = None,
+        quantized: QuantizedPalette | None = None,
+        config: LocalPaletteConfig | None = None,
+        scale: int = 1,
+        transform: PatchTransform | None = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """For each patch from `image` find `k_neigh` closest palette patches, on integer data if `quantized` is given.
+
+    With `quantized` the float `palette` and `neigh` are not used and may be None.
+    """
+    config = config if config is not None else default_config.local_palette
+
+    pixels, scale = _decode(image, config, scale)
+    patches = get_patches(pixels, config, config.predict_coverage, scale)
+    if transform is not None:
+        patches = transform.transform(patches)
+    if quantized is not None:
+        return quantize.k_closest(patches, quantized, config.k_neigh)
+    return k_closest(patches, palette, config.k_neigh, neigh)
+
+
+def scores1(histogram: np.ndarray, class_histograms: dict[str, np.ndarray]) -> dict[str, float]:
+    """Per class distance (lower is better) of image `histogram` from averaged class histograms."""
+    return {cls: abs(cls_histogram - histogram).sum() for cls, cls_histogram in class_histograms.items()}
+
+
+def scores1_batch(
+        histograms: np.ndarray | scipy.sparse.spmatrix,
+        class_histograms: dict[str, np.ndarray]
+) -> Tuple[list[str], np.ndarray]:
+    """`scores1` of many image histograms (one per row) at once, returns (classes, (images, classes) scores)."""
+    classes = list(class_histograms)
+    class_matrix = np.vstack([class_histograms[cls] for cls in classes])
+    # Bound the (images x classes x palette) difference block like neighbour search chunks
+    chunk_size = max(1, int(default_config.memory.search_chunk.to_Byte()) // (8 * class_matrix.size))
+    chunk_size = min(chunk_size, max(histograms.shape[0], 1))
+    scores = np.empty((histograms.shape[0], len(classes)))
+    with memory.governor.reserve("search", 8 * chunk_size * class_matrix.size):
+        for offset in range(0, histograms.shape[0], chunk_size):
+            block = histograms[offset: offset + chunk_size]
+            block = block.toarray() if scipy.sparse.issparse(block) else np.asarray(block)
+            scores[offset: offset + len(block)] = np.abs(block[:, None, :] - class_matrix[None, :, :]).sum(axis=2)
+    return classes, scores
+
 
-    patches = get_patches(image_array, default_config.local_palette, default_config.local_palette.predict_coverage)
-    return k_closest(patches, palette, default_config.local_palette.k_neigh, neigh)
+def scores2(matches: dict[str, Tuple[np.ndarray, np.ndarray]]) -> dict[str, float]:
+    """Per class score (lower is better) of `match2` results against each class palette."""
+    # TODO: how to pick closest class? minimum sum of distances for now
+    return {cls: np.sum(distances) for cls, (distances, _) in matches.items()}
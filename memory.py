@@ -0,0 +1,116 @@
+import contextlib
+import threading
+
+import psutil
+
+from config import default_config
+
+
+class MemoryGovernor:
+    """Single byte budget shared by every memory hungry stage (loader batches, patch buffers, k-means, search).
+
+    Stages reserve their estimated size before allocating and release it when the memory is freed. Only
+    top-level reservations block while other threads hold the budget they need (backpressure). A thread
+    that already holds a reservation is never blocked: its nested reservations (k-means inside a patch
+    buffer or a sweep point) count against the budget but are granted at once, waiting for them while
+    holding the outer reservation could deadlock threads on each other. A single reservation larger than
+    the whole budget runs alone. While any reservation is held, process RSS is sampled to record the actual
+    peak of each stage.
+    """
+
+    def __init__(self, total: int, sample_interval: float = 0.1):
+        self.total = total
+        self.available = total
+        self.sample_interval = sample_interval
+        self._condition = threading.Condition()
+        # Bytes held per thread, to tell own from other threads' reservations
+        self._held: dict[int, int] = dict()
+        # Active reservation count per stage
+        self._active: dict[str, int] = dict()
+        self.peak_reserved: dict[str, int] = dict()
+        self.peak_rss: dict[str, int] = dict()
+        self._reserved: dict[str, int] = dict()
+        self._process = psutil.Process()
+        self._sampler: threading.Thread | None = None
+
+    def _sample(self):
+        while True:
+            with self._condition:
+                if not self._active:
+                    self._sampler = None
+                    return
+                stages = list(self._active)
+            rss = self._process.memory_info().rss
+            with self._condition:
+                for stage in stages:
+                    self.peak_rss[stage] = max(self.peak_rss.get(stage, 0), rss)
+                self._condition.wait(self.sample_interval)
+
+    def limit(self, total: int):
+        """Lower the budget to `total` (e.g. a run's own budget), outstanding reservations stay counted."""
+        with self._condition:
+            total = min(int(total), self.total)
+            self.available -= self.total - total
+            self.total = total
+            self._condition.notify_all()
+
+    def clamp(self, size: int, minimum: int) -> int:
+        """`size` shrunk to the whole budget, but at least `minimum` (buffers that can never fit otherwise).
+
+        Sizes within the budget are left alone, reserving them waits for other stages instead.
+        """
+        return max(min(int(size), self.total), int(minimum))
+
+    def acquire(self, stage: str, size: int, thread: int | None = None) -> int:
+        """Block until `size` bytes are available (unless `thread` holds a reservation already), return the
+        reserved size to pass to `release`."""
+        thread = thread if thread is not None else threading.get_ident()
+        size = max(0, min(int(size), self.total))
+        with self._condition:
+            self._condition.wait_for(lambda: thread in self._held or self.available >= size)
+            self.available -= size
+            self._held[thread] = self._held.get(thread, 0) + size
+            self._active[stage] = self._active.get(stage, 0) + 1
+            self._reserved[stage] = self._reserved.get(stage, 0) + size
+            self.peak_reserved[stage] = max(self.peak_reserved.get(stage, 0), self._reserved[stage])
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, daemon=True)
+                self._sampler.start()
+        return size
+
+    def release(self, stage: str, size: int, thread: int | None = None):
+        """Return a reservation, `thread` is the acquiring thread if released from another one."""
+        thread = thread if thread is not None else threading.get_ident()
+        with self._condition:
+            self.available += size
+            self._held[thread] = self._held.get(thread, 0) - size
+            if self._held[thread] == 0:
+                del self._held[thread]
+            self._reserved[stage] -= size
+            self._active[stage] -= 1
+            if self._active[stage] == 0:
+                del self._active[stage]
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def reserve(self, stage: str, size: int):
+        # Generators holding a reservation across `yield` may be closed by another thread
+        thread = threading.get_ident()
+        size = self.acquire(stage, size, thread)
+        try:
+            yield size
+        finally:
+            self.release(stage, size, thread)
+
+    def report(self) -> str:
+        """Peak reserved bytes and peak sampled process RSS of every stage seen so far."""
+        mib = 1024 * 1024
+        lines = [f"{'stage':<12} {'reserved MiB':>13} {'peak RSS MiB':>13}"]
+        for stage in sorted(self.peak_reserved):
+            lines.append(f"{stage:<12} {self.peak_reserved[stage] / mib:>13.1f} "
+                         f"{self.peak_rss.get(stage, 0) / mib:>13.1f}")
+        lines.append(f"budget {self.total / mib:.1f} MiB")
+        return "\n".join(lines)
+
+
+governor = MemoryGovernor(int(default_config.memory.budget.to_Byte()), default_config.memory.sample_interval)
@@ -0,0 +1,132 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+import config as config_module
+import utils
+from config import default_config
+from utils import ClassificationTarget
+
+# Emulate conditional compilation
+if config_module.PROFILE:
+    def tqdm(*args, **_):
+        return args[0]
+else:
+    from tqdm import tqdm
+
+
+COLUMNS = ("path", "width", "height", "bands", "file_size", "format")
+
+_table: pd.DataFrame | None = None
+_stale = False
+
+
+def image_files(entry: str) -> list[str]:
+    """Dataset relative image files backing a label file `entry` (four squares per painting in subrandom mode)."""
+    if default_config.subrandom:
+        stem = entry.split(".")[0]
+        return [f"{stem}_{number}.jpg" for number in range(1, 5)]
+    return [entry]
+
+
+def dataset_entries() -> list[str]:
+    """All image files referenced by train and validation label files of every classification target."""
+    entries = dict()
+    for target in ClassificationTarget:
+        for split in ("train", "val"):
+            labels = pd.read_csv(
+                os.path.join(default_config.dataset_labels_path, f"{target.name.lower()}_{split}.csv"),
+                names=["path", "encoded_cls"])
+            entries.update(dict.fromkeys(file for entry in labels["path"] for file in image_files(entry)))
+    return list(entries)
+
+
+def index_fingerprint(entries: list[str] | None = None) -> str:
+    """Hash of the dataset location, subrandom mode and image files label files reference, which a table covers."""
+    entries = entries if entries is not None else dataset_entries()
+    digest = hashlib.sha256(json.dumps([default_config.dataset_path, default_config.subrandom]).encode())
+    for entry in entries:
+        digest.update(entry.encode())
+    return digest.hexdigest()[:16]
+
+
+def _read_header(path: str) -> tuple | None:
+    full_path = os.path.join(default_config.dataset_path, path)
+    try:
+        # Opening is lazy, only the header is parsed until pixel data is accessed
+        with Image.open(full_path) as image:
+            return (path, image.width, image.height, len(image.getbands()), os.path.getsize(full_path),
+                    image.format or "")
+    except FileNotFoundError:
+        return None
+
+
+def scan(paths: list[str], workers: int | None = None) -> pd.DataFrame:
+    """Read headers of all `paths` in parallel, missing files are left out of the table."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or 4 * (os.cpu_count() or 1)) as executor:
+        rows = [row for row in tqdm(executor.map(_read_header, paths, chunksize=64), desc="scan", total=len(paths))
+                if row is not None]
+    return pd.DataFrame(rows, columns=COLUMNS).set_index("path")
+
+
+def save(table: pd.DataFrame, path: str, fingerprint: str):
+    """Persist `table` column by column (no pickled objects) in a NumPy archive, with its `index_fingerprint`."""
+    np.savez(
+        path,
+        fingerprint=np.array(fingerprint),
+        path=table.index.to_numpy(dtype=str),
+        width=table["width"].to_numpy(dtype=np.int32),
+        height=table["height"].to_numpy(dtype=np.int32),
+        bands=table["bands"].to_numpy(dtype=np.uint8),
+        file_size=table["file_size"].to_numpy(dtype=np.int64),
+        format=table["format"].to_numpy(dtype=str),
+    )
+
+
+def load(path: str) -> tuple[pd.DataFrame, str]:
+    """Table stored at `path` and the `index_fingerprint` it was built for ("" for tables without one)."""
+    with np.load(path) as columns:
+        fingerprint = str(columns["fingerprint"]) if "fingerprint" in columns.files else ""
+        return pd.DataFrame({column: columns[column] for column in COLUMNS}).set_index("path"), fingerprint
+
+
+def table() -> pd.DataFrame | None:
+    """Metadata table at `default_config.metadata_path`, or None if it was not built yet or is stale.
+
+    A table built for another dataset path, subrandom mode or label files is ignored (the loader then
+    falls back to reading image headers) until it is rebuilt with `build`.
+    """
+    global _table, _stale
+    if _table is None and not _stale and os.path.exists(default_config.metadata_path):
+        loaded, fingerprint = load(default_config.metadata_path)
+        if fingerprint != index_fingerprint():
+            print(f"Ignoring stale metadata table {default_config.metadata_path}, rebuild it with metadata.py")
+            _stale = True
+            return None
+        _table = loaded
+    return _table
+
+
+def build(workers: int | None = None) -> pd.DataFrame:
+    """Scan the whole dataset and persist the table at `default_config.metadata_path`."""
+    global _table, _stale
+    entries = dataset_entries()
+    _table = scan(entries, workers)
+    save(_table, default_config.metadata_path, index_fingerprint(entries))
+    _stale = False
+    return _table
+
+
+def decoded_size(row: pd.Series, *configs) -> int:
+    """Bytes of pixel data of an image once decoded at the draft scale `configs` allow."""
+    scale = utils.draft_scale((row["width"], row["height"]), row["format"], *configs)
+    return -(-row["width"] // scale) * -(-row["height"] // scale) * row["bands"]
+
+
+if __name__ == '__main__':
+    build()
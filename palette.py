@@ -1,3 +1,7 @@
+import hashlib
+import os
+import pickle
+
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -9,9 +13,13 @@ if config_module.PROFILE:  # Emulate conditional compilation
 else:
     from tqdm import tqdm
 from sklearn.cluster import MiniBatchKMeans
+from sklearn.neighbors import KNeighborsClassifier
+import PIL.Image
 from PIL.Image import Image
+import memory
 import utils
 from config import GlobalPaletteConfig, LocalPaletteConfig
+from utils import PatchTransform
 
 
 def contrast(image):
@@ -22,96 +30,305 @@ def normalize_patch(patch, eps=10):
     return (patch - patch.mean()) / np.sqrt(patch.var() + eps)
 
 
-def whiten(x_list):
-    x_norm = (x_list - x_list.mean(axis=0)) / x_list.std(axis=0)
-    cov = np.cov(x_norm, rowvar=False)
-    u, s, v = np.linalg.svd(cov)
-
-    x_zca = u.dot(np.diag(1.0 / np.sqrt(s + 0.1))).dot(u.T).dot(x_norm.T).T
-    return x_zca
-
-
-MAX_PATCHES_TOTAL_SIZE: int = 1 * 1024 * 1024 * 1024
+# Pixel bytes of patches one palette is generated from, buffers shrink below it when the memory budget is short
+MAX_PATCHES_TOTAL_SIZE: int = int(config_module.default_config.memory.patch_buffer.to_Byte())
 
 
 def generate_palette(
         images: list[Image],
         config: config_module.GlobalPaletteConfig | config_module.LocalPaletteConfig,
         verbose: bool = False,
-        whitening: bool = False
+        transform: PatchTransform | None = None,
+        init: np.ndarray | None = None
 ):
     # Preallocate memory for all patches
 
     def image_byte_size(image: Image) -> int:
         return image.height * image.width * len(image.getbands())
 
+    dimension = config.patch_size * config.patch_size * 3
     patch_memory_size = min(MAX_PATCHES_TOTAL_SIZE, sum(map(image_byte_size, images)))
-    patch_count = patch_memory_size // (config.patch_size * config.patch_size * 3)
+    # Patches are stored as float64, 8 bytes per pixel byte
+    requested_count = patch_memory_size // dimension
+    minimum_count = min(requested_count, config.batching_k_means.number_of_clusters)
+    patch_count = memory.governor.clamp(8 * requested_count * dimension, 8 * minimum_count * dimension) \
+        // (8 * dimension)
+    if patch_count < requested_count:
+        print(f"Patch buffer shrunk from {requested_count} to {patch_count} patches to fit the memory budget")
 
+    # Blocks until other stages free enough of the budget
+    with memory.governor.reserve("patches", 8 * patch_count * dimension):
+        return _generate_palette(images, config, patch_count, verbose, transform, init)
+
+
+def _generate_palette(
+        images: list[Image],
+        config: config_module.GlobalPaletteConfig | config_module.LocalPaletteConfig,
+        patch_count: int,
+        verbose: bool,
+        transform: PatchTransform | None,
+        init: np.ndarray | None
+):
     patches = np.zeros((patch_count, config.patch_size * config.patch_size * 3))
-    image_generator = (np.asarray(image, dtype='B').reshape(image.height, image.width, len(image.getbands()))
-                       for image in images)
+    image_generator = (utils.decode(image, config) for image in images)
     # TODO: fragmentation?
     offset = 0
-    for image in tqdm(image_generator, desc="patches"):
+    for image, scale in tqdm(image_generator, desc="patches"):
         if patch_count <= 0:
             break
-        local_patches = utils.get_patches(image, config, patch_count)
+        local_patches = utils.get_patches(image, config, patch_count, scale)
         local_patch_count = len(local_patches)
         patches[offset: offset + local_patch_count] = local_patches
         del local_patches
         offset += local_patch_count
         patch_count -= local_patch_count
 
-    if whitening:
-        patches = whiten(patches)
+    if transform is not None:
+        patches = transform.transform(patches)
 
-    assert config.parent is not None
+    return fit_palette(patches, config, verbose, init)
+
+
+class PatchReservoir:
+    """Uniform fixed-size sample of all patches of a class, collected in a single pass (reservoir Algorithm L).
+
+    Which offered patches enter the reservoir depends only on how many patches each image offers, not on
+    their content. `admit` therefore decides from image dimensions alone whether an image contributes at
+    all, so the loader never decodes images that would not enter the reservoir, and `offer` draws only as
+    many patches as were scheduled for the image.
+    """
+
+    def __init__(self, config: config_module.GlobalPaletteConfig | config_module.LocalPaletteConfig,
+                 seed: int | None = None):
+        self.config = config
+        self.capacity = config.reservoir_size
+        self.patches = np.zeros((self.capacity, config.patch_size * config.patch_size * 3), dtype=np.uint8)
+        self.seen = 0
+        self._rng = np.random.default_rng(seed)
+        self._w = np.exp(np.log(self._rng.random()) / self.capacity)
+        self._next = self.capacity + self._skip()
+        # Reservoir slots scheduled for admitted but not yet offered images
+        self._pending: dict[str, np.ndarray] = dict()
+
+    def _skip(self) -> int:
+        return int(np.floor(np.log(self._rng.random()) / np.log1p(-self._w)))
+
+    def schedule(self, patch_count: int) -> np.ndarray:
+        """Advance over `patch_count` offered patches, return reservoir slots the accepted ones are written to."""
+        end = self.seen + patch_count
+        slots = list(range(self.seen, min(end, self.capacity)))
+        while self._next < end:
+            slots.append(int(self._rng.integers(self.capacity)))
+            self._w *= np.exp(np.log(self._rng.random()) / self.capacity)
+            self._next += self._skip() + 1
+        self.seen = end
+        return np.array(slots, dtype=np.intp)
+
+    def admit(self, path: str, size: tuple[int, int], scale: int) -> bool:
+        """`loader.ImageIterator` hook: should the image at `path` with decoded `size` be decoded at all."""
+        width, height = size
+        if width < self.config.patch_size or height < self.config.patch_size:
+            return False
+        patch_bytes = self.config.patch_size * self.config.patch_size * 3
+        patch_count = utils.sample_count(height, width, self.config, MAX_PATCHES_TOTAL_SIZE // patch_bytes, scale)
+        if self.config.max_patches_per_image:
+            patch_count = min(patch_count, self.config.max_patches_per_image)
+        slots = self.schedule(patch_count)
+        if len(slots) > 0:
+            self._pending[path] = slots
+        return len(slots) > 0
+
+    def offer(self, image: Image):
+        """Write patches of an image admitted by `admit` into its scheduled slots."""
+        slots = self._pending.pop(image.filename)
+        pixels, scale = utils.decode(image, self.config)
+        patches = utils.get_patches(pixels, self.config, len(slots), scale)
+        # Replacements may hit the same slot more than once, written in order so that the latest one stays
+        for slot, patch in zip(slots[:len(patches)], patches):
+            self.patches[slot] = patch
+
+    def sample(self) -> np.ndarray:
+        return self.patches[:min(self.seen, self.capacity)]
+
+
+def generate_reservoir_palette(
+        image_iterator,
+        config: config_module.GlobalPaletteConfig | config_module.LocalPaletteConfig,
+        verbose: bool = False,
+        transform: PatchTransform | None = None,
+        init: np.ndarray | None = None
+):
+    """Palette of a whole class from a reservoir sample, replaces per batch `generate_palette` + `merge_palettes`."""
+    patches = reservoir_sample(image_iterator, config)
+    if transform is not None:
+        patches = transform.transform(patches)
+    return fit_palette(patches, config, verbose, init)
 
-    kmeans = (
-        MiniBatchKMeans(
-            n_clusters=config.batching_k_means.number_of_clusters,
-            random_state=config.parent.random_seed,
-            verbose=verbose,
-            n_init=1,
-            max_iter=config.batching_k_means.max_iterations,
-            batch_size=config.batching_k_means.batch_size)
-        .fit(patches))
-    # return kmeans.labels_, kmeans.cluster_centers_
-    return kmeans.cluster_centers_
+
+def reservoir_sample(
+        image_iterator,
+        config: config_module.GlobalPaletteConfig | config_module.LocalPaletteConfig
+) -> np.ndarray:
+    """Stream a class `loader.ImageIterator` once through a `PatchReservoir`, skipping images it rejects."""
+    assert config.parent is not None
+    reservoir = PatchReservoir(config, config.parent.random_seed)
+    image_iterator.admit = reservoir.admit
+    for image_batch in tqdm(image_iterator, desc=" reservoir"):
+        for image in image_batch:
+            reservoir.offer(image)
+    return reservoir.sample()
 
 
 def merge_palettes(palettes: list[np.ndarray],
                    config: config_module.GlobalPaletteConfig | config_module.LocalPaletteConfig, verbose: bool = False,
-                   whitening: bool = False):
+                   init: np.ndarray | None = None):
+    # Palettes of transformed (whitened, projected) patches are already in the transformed space
     patches_matrix = np.vstack(palettes)
 
-    if whitening:
-        patches_matrix = whiten(patches_matrix)
+    return fit_palette(patches_matrix, config, verbose, init)
+
+
+def warm_start_init(previous: np.ndarray | None, patches: np.ndarray,
+                    config: config_module.GlobalPaletteConfig | config_module.LocalPaletteConfig) -> np.ndarray | None:
+    """Initial centroids from a previously stored palette, or None (k-means++) if it does not fit `config`.
+
+    Larger stored palettes are subsampled, smaller ones are topped up with random `patches`.
+    """
+    n_clusters = config.batching_k_means.number_of_clusters
+    if not config.batching_k_means.warm_start or previous is None or previous.shape[1] != patches.shape[1]:
+        return None
+    rng = np.random.default_rng(config.parent.random_seed)
+    if previous.shape[0] >= n_clusters:
+        return previous[rng.choice(previous.shape[0], n_clusters, replace=False)].astype(np.float64)
+    extra = patches[rng.choice(patches.shape[0], n_clusters - previous.shape[0], replace=False)]
+    return np.vstack([previous, extra]).astype(np.float64)
+
+
+def k_means_memory(patches: np.ndarray,
+                   config: config_module.GlobalPaletteConfig | config_module.LocalPaletteConfig) -> int:
+    """Estimated bytes `fit_palette` allocates on top of `patches`."""
+    n_clusters = config.batching_k_means.number_of_clusters
+    # Integer patches (reservoir samples) are converted to float64
+    copy = 0 if np.issubdtype(patches.dtype, np.floating) else 8 * patches.size
+    # Labels and inertia per patch, mini-batch distances, centres with their previous copies and k-means++ trials
+    return (copy + 16 * patches.shape[0] + 8 * config.batching_k_means.batch_size * n_clusters
+            + 3 * 8 * n_clusters * patches.shape[1] + 8 * patches.shape[0] * (2 + int(np.log(n_clusters))))
 
-    kmeans = (
-        MiniBatchKMeans(
-            n_clusters=config.batching_k_means.number_of_clusters,
-            random_state=config.parent.random_seed,
-            verbose=verbose,
-            n_init=1,
-            max_iter=config.batching_k_means.max_iterations,
-            batch_size=config.batching_k_means.batch_size
-        ).fit(patches_matrix))
+
+def fit_palette(patches: np.ndarray,
+                config: config_module.GlobalPaletteConfig | config_module.LocalPaletteConfig, verbose: bool = False,
+                init: np.ndarray | None = None):
+    """Cluster `patches` into `config.batching_k_means.number_of_clusters` representative patches.
+
+    `init` is a previously stored palette to warm start from (see `warm_start_init`); with a tolerance set,
+    training then stops as soon as centroids settle, so retraining cost follows how much the data changed.
+    """
+    assert config.parent is not None
+
+    init = warm_start_init(init, patches, config)
+    with memory.governor.reserve("k-means", k_means_memory(patches, config)):
+        kmeans = (
+            MiniBatchKMeans(
+                n_clusters=config.batching_k_means.number_of_clusters,
+                init=init if init is not None else "k-means++",
+                random_state=config.parent.random_seed,
+                verbose=verbose,
+                n_init=1,
+                max_iter=config.batching_k_means.max_iterations,
+                batch_size=config.batching_k_means.batch_size,
+                tol=config.batching_k_means.tolerance
+            ).fit(patches))
 
     # return kmeans.labels_, kmeans.cluster_centers_
     return kmeans.cluster_centers_
 
 
+def build_lookup_table(palette: np.ndarray, bits: int, transform: PatchTransform | None = None,
+                       chunk_size: int = 1 << 16) -> np.ndarray:
+    """Map every colour quantized to `bits` per channel onto the index of its closest 1x1 palette entry.
+
+    Returns uint16 array of shape (2**bits, 2**bits, 2**bits) indexed by `rgb >> (8 - bits)`. Palettes of
+    transformed patches need the `transform` they were trained with.
+    """
+    assert palette.shape[1] == 3 and palette.shape[0] <= np.iinfo(np.uint16).max + 1
+    side = 1 << bits
+    shift = 8 - bits
+
+    neigh = KNeighborsClassifier(n_neighbors=1).fit(palette, np.arange(palette.shape[0]))
+    table = np.empty(side ** 3, dtype=np.uint16)
+    for offset in tqdm(range(0, side ** 3, chunk_size), desc="lookup table"):
+        # Cells of the chunk from their flat index, each represented by its centre colour
+        cells = np.arange(offset, min(offset + chunk_size, side ** 3))
+        chunk = np.stack([cells >> (2 * bits), (cells >> bits) & (side - 1), cells & (side - 1)], axis=1)
+        chunk = (chunk << shift) + ((1 << shift) >> 1)
+        if transform is not None:
+            chunk = transform.transform(chunk)
+        table[offset: offset + len(chunk)] = neigh.kneighbors(chunk, return_distance=False)[:, 0]
+    return table.reshape(side, side, side)
+
+
+def lookup_table_key(palette: np.ndarray, bits: int, transform: PatchTransform | None = None) -> str:
+    """Hash of what a lookup table was built from, stored with it to detect stale tables."""
+    digest = hashlib.sha256(np.ascontiguousarray(palette).tobytes())
+    digest.update(str(bits).encode())
+    if transform is not None:
+        digest.update(pickle.dumps(transform))
+    return digest.hexdigest()[:16]
+
+
+def load_lookup_table(path: str, palette: np.ndarray, bits: int,
+                      transform: PatchTransform | None = None) -> np.ndarray | None:
+    """Table stored by `store_lookup_table` at `path`, or None if missing or built for another palette or bits."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as file:
+        stored = pickle.load(file)
+    if not isinstance(stored, dict) or stored.get("key") != lookup_table_key(palette, bits, transform):
+        return None
+    return stored["table"]
+
+
+def store_lookup_table(path: str, table: np.ndarray, palette: np.ndarray, bits: int,
+                       transform: PatchTransform | None = None):
+    with open(path, "wb") as file:
+        pickle.dump({"key": lookup_table_key(palette, bits, transform), "bits": bits, "table": table}, file)
+
+
+def palette_mosaic(palette: np.ndarray, config: GlobalPaletteConfig | LocalPaletteConfig, upscale: int = 1,
+                   grid: int = 0) -> np.ndarray:
+    """All palette patches tiled into one uint8 RGB image, `upscale` times enlarged and `grid` pixels apart."""
+    count = palette.shape[0]
+    columns = max(int(np.ceil(np.sqrt(count))), 1)
+    rows = -(-count // columns)
+    cell = config.patch_size * upscale
+
+    patches = np.clip(palette, 0, 255).astype(np.uint8).reshape(count, config.patch_size, config.patch_size, 3)
+    patches = patches.repeat(upscale, axis=1).repeat(upscale, axis=2)
+    # Each cell carries its grid line on the right and bottom, unused cells stay white
+    cells = np.full((rows * columns, cell + grid, cell + grid, 3), 255, dtype=np.uint8)
+    cells[:count, :cell, :cell] = patches
+    mosaic = cells.reshape(rows, columns, cell + grid, cell + grid, 3).transpose(0, 2, 1, 3, 4)
+    mosaic = mosaic.reshape(rows * (cell + grid), columns * (cell + grid), 3)
+    return mosaic[:mosaic.shape[0] - grid, :mosaic.shape[1] - grid]
+
+
+def save_palette_image(palette: np.ndarray, config: GlobalPaletteConfig | LocalPaletteConfig, path: str,
+                       image_config: config_module.PaletteImageConfig | None = None):
+    """Write the palette mosaic to `path` with PIL, unless palette images are disabled."""
+    image_config = image_config if image_config is not None else config_module.default_config.palette_images
+    if not image_config.enabled:
+        return
+    upscale = max(image_config.cell_size // config.patch_size, 1)
+    PIL.Image.fromarray(palette_mosaic(palette, config, upscale, image_config.grid)).save(path)
+
+
 def plot_palette(palette: np.ndarray, local_config: GlobalPaletteConfig | LocalPaletteConfig):
-    # assumes palette is of "int-sqrtable" size, may not plot all if that's not the case
-    patches_num = palette.shape[0]
-    side = int(np.sqrt(patches_num))
-
-    fig = plt.figure(figsize=(side, side))
-    for xx in range(patches_num):
-        plt.subplot(side, side, xx + 1)
-        plt.imshow((palette[xx].astype(int)).reshape(local_config.patch_size, local_config.patch_size, 3))
-        plt.axis('off')
+    """Figure of the palette mosaic, for interactive use (files are written by `save_palette_image`)."""
+    image_config = config_module.default_config.palette_images
+    mosaic = palette_mosaic(palette, local_config, max(image_config.cell_size // local_config.patch_size, 1),
+                            image_config.grid)
+    fig = plt.figure(figsize=(mosaic.shape[1] / 100, mosaic.shape[0] / 100))
+    plt.imshow(mosaic)
+    plt.axis('off')
 
     return fig
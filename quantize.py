@@ -0,0 +1,112 @@
+import dataclasses
+
+import numpy as np
+
+import memory
+from config import default_config
+
+
+QUANTIZATIONS = ("none", "uint8", "int8")
+
+
+@dataclasses.dataclass
+class QuantizedPalette:
+    """Integer palette representation, `palette ~= values * scale + offset`."""
+    values: np.ndarray
+    scale: float
+    offset: float
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return self.values.shape
+
+    def dequantize(self) -> np.ndarray:
+        return self.values.astype(np.float64) * self.scale + self.offset
+
+    def quantize_queries(self, patches: np.ndarray) -> np.ndarray:
+        """Quantize query patches with this palette's scale and offset."""
+        if self.values.dtype == np.uint8 and patches.dtype == np.uint8:
+            return patches
+        info = np.iinfo(self.values.dtype)
+        return np.clip(np.rint((patches - self.offset) / self.scale), info.min, info.max).astype(self.values.dtype)
+
+
+def quantize_palette(palette: np.ndarray, kind: str) -> QuantizedPalette:
+    """Store `palette` as uint8 (pixel space palettes) or int8 with per-palette scale (e.g. whitened palettes)."""
+    if kind == "uint8":
+        return QuantizedPalette(np.clip(np.rint(palette), 0, 255).astype(np.uint8), 1.0, 0.0)
+    elif kind == "int8":
+        low, high = float(palette.min()), float(palette.max())
+        offset = (high + low) / 2
+        scale = max(high - low, np.finfo(np.float64).eps) / 254
+        return QuantizedPalette(np.clip(np.rint((palette - offset) / scale), -127, 127).astype(np.int8), scale, offset)
+    raise ValueError(f"Unknown quantization {kind!r}, expected one of {QUANTIZATIONS}")
+
+
+def k_closest(
+        patches: np.ndarray,
+        palette: QuantizedPalette,
+        k: int,
+        chunk_size: int | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """Counterpart of `utils.k_closest` on a quantized palette, returns (distances, indices) like `kneighbors`.
+
+    Squared distances are |q|^2 + |p|^2 - 2 q.p of the integer values. Norms and cross term go through
+    float64 (BLAS), as NumPy has no BLAS path for integer matrix products. Every partial sum is an integer
+    below 2^53 (3072 * 255^2 ~ 2^27.6 for 32x32 patches), so the result is exact, ties included. Only the
+    palette storage is 8-bit, the float64 copy lives for the duration of the call. Query chunks are sized
+    by the search chunk budget and reserved from `memory.governor`.
+    """
+    values = palette.values.astype(np.float64)
+    values_norms = np.einsum("ij,ij->i", values, values)
+    k = min(k, values.shape[0])
+    # float64 queries, cross term and squared distances of one query row
+    row_bytes = 8 * (values.shape[1] + 2 * values.shape[0])
+    if chunk_size is None:
+        chunk_size = max(1, int(default_config.memory.search_chunk.to_Byte()) // row_bytes)
+    chunk_size = min(chunk_size, max(patches.shape[0], 1))
+
+    distances = np.empty((patches.shape[0], k))
+    indices = np.empty((patches.shape[0], k), dtype=np.intp)
+    with memory.governor.reserve("search", row_bytes * chunk_size):
+        for offset in range(0, patches.shape[0], chunk_size):
+            queries = palette.quantize_queries(patches[offset: offset + chunk_size]).astype(np.float64)
+            queries_norms = np.einsum("ij,ij->i", queries, queries)
+            squared = (queries_norms[:, None] + values_norms[None, :]) - 2 * (queries @ values.T)
+            closest = np.argpartition(squared, k - 1, axis=1)[:, :k]
+            closest_squared = np.take_along_axis(squared, closest, axis=1)
+            order = np.argsort(closest_squared, axis=1)
+            indices[offset: offset + len(queries)] = np.take_along_axis(closest, order, axis=1)
+            distances[offset: offset + len(queries)] = \
+                np.sqrt(np.clip(np.take_along_axis(closest_squared, order, axis=1), 0, None)) * palette.scale
+    return distances, indices
+
+
+def benchmark(palette_size: int = 256, dimension: int = 32 * 32 * 3, query_count: int = 4096, k: int = 3,
+              number: int = 5) -> dict[str, float]:
+    """Seconds per search of random uint8 queries against a random palette: float kneighbors vs quantized.
+
+    `agreement` is the share of queries whose k closest entries (in order) match between both searches,
+    `max_error` the largest absolute distance difference.
+    """
+    import timeit
+
+    from sklearn.neighbors import KNeighborsClassifier
+
+    rng = np.random.default_rng(0)
+    palette = rng.integers(0, 256, (palette_size, dimension)).astype(np.float64)
+    queries = rng.integers(0, 256, (query_count, dimension), dtype=np.uint8)
+    neigh = KNeighborsClassifier(n_neighbors=k).fit(palette, np.arange(palette_size))
+    quantized = quantize_palette(palette, "uint8")
+    float_distances, float_indices = neigh.kneighbors(queries, n_neighbors=k)
+    distances, indices = k_closest(queries, quantized, k)
+    return {
+        "float": timeit.timeit(lambda: neigh.kneighbors(queries, n_neighbors=k), number=number) / number,
+        "quantized": timeit.timeit(lambda: k_closest(queries, quantized, k), number=number) / number,
+        "agreement": float((float_indices == indices).all(axis=1).mean()),
+        "max_error": float(np.abs(float_distances - distances).max()),
+    }
+
+
+if __name__ == '__main__':
+    print(benchmark())
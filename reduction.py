@@ -0,0 +1,86 @@
+import numpy as np
+from sklearn.decomposition import PCA
+from sklearn.random_projection import GaussianRandomProjection
+
+import config as config_module
+import utils
+
+# Emulate conditional compilation
+if config_module.PROFILE:
+    def tqdm(*args, **_):
+        return args[0]
+else:
+    from tqdm import tqdm
+
+
+REDUCTIONS = ("pca", "random")
+
+
+class PatchProjection:
+    """Linear projection of patches to `dimension` dimensions (PCA or Gaussian random projection).
+
+    Palettes are trained and searched in the reduced space, `inverse_transform` reconstructs them in pixel
+    space (for plotting). Both directions are applied in float32 batches.
+    """
+
+    def __init__(self, kind: str, dimension: int, random_state: int | None = None):
+        if kind not in REDUCTIONS:
+            raise ValueError(f"Unknown reduction {kind!r}, expected one of {REDUCTIONS}")
+        self.kind = kind
+        self.dimension = dimension
+        self.random_state = random_state
+        self.mean: np.ndarray | None = None
+        self.components: np.ndarray | None = None
+        self.inverse_components: np.ndarray | None = None
+
+    def fit(self, patches: np.ndarray) -> "PatchProjection":
+        if self.dimension > min(patches.shape):
+            raise ValueError(f"Cannot reduce {patches.shape[0]} patches of dimension {patches.shape[1]} to "
+                             f"{self.dimension} dimensions, reduced-dimension must not exceed either of them")
+        patches = patches.astype(np.float32)
+        if self.kind == "pca":
+            pca = PCA(n_components=self.dimension, svd_solver="randomized", random_state=self.random_state)
+            pca.fit(patches)
+            self.mean = pca.mean_.astype(np.float32)
+            self.components = pca.components_.astype(np.float32)
+            # Rows of components are orthonormal, so reconstruction uses them as well
+            self.inverse_components = self.components
+        else:
+            projection = GaussianRandomProjection(n_components=self.dimension, random_state=self.random_state)
+            projection.fit(patches)
+            self.mean = np.zeros(patches.shape[1], dtype=np.float32)
+            self.components = projection.components_.astype(np.float32)
+            self.inverse_components = np.linalg.pinv(self.components).T.astype(np.float32)
+        return self
+
+    def transform(self, patches: np.ndarray, chunk_size: int = 1 << 14) -> np.ndarray:
+        assert self.components is not None, "projection is not fitted"
+        reduced = np.empty((patches.shape[0], self.dimension), dtype=np.float32)
+        for offset in range(0, patches.shape[0], chunk_size):
+            chunk = patches[offset: offset + chunk_size].astype(np.float32)
+            reduced[offset: offset + len(chunk)] = (chunk - self.mean) @ self.components.T
+        return reduced
+
+    def inverse_transform(self, reduced: np.ndarray) -> np.ndarray:
+        assert self.inverse_components is not None, "projection is not fitted"
+        return reduced.astype(np.float32) @ self.inverse_components + self.mean
+
+
+def fit_projection(image_iterators, config: config_module.GlobalPaletteConfig | config_module.LocalPaletteConfig):
+    """Fit projection for `config` on `config.reduction_sample_size` patches drawn evenly from all classes."""
+    image_iterators = list(image_iterators)
+    quota = max(config.reduction_sample_size // max(len(image_iterators), 1), 1)
+    sample = list()
+    for image_iterator in image_iterators:
+        remaining = quota
+        for image_batch in tqdm(image_iterator, desc=" projection sample"):
+            for image in image_batch:
+                if remaining <= 0:
+                    break
+                pixels, scale = utils.decode(image, config)
+                patches = utils.get_patches(pixels, config, remaining, scale)
+                sample.append(patches)
+                remaining -= len(patches)
+            if remaining <= 0:
+                break
+    return PatchProjection(config.reduction, config.reduced_dimension, config.parent.random_seed).fit(np.vstack(sample))
@@ -0,0 +1,311 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import pickle
+import socket
+import threading
+import time
+import uuid
+
+import numpy as np
+
+import config as config_module
+import loader
+import memory
+import palette
+import utils
+from config import default_config
+
+# Emulate conditional compilation
+if config_module.PROFILE:
+    def tqdm(*args, **_):
+        return args[0]
+else:
+    from tqdm import tqdm
+
+
+# Queue directory layout, shared by all nodes (e.g. over NFS):
+#   queue.json        method, target and config fingerprint the queue was planned with
+#   shards/<id>.json  shard specification: class and image paths
+#   leases/<id>       present while a worker holds the shard, its mtime is the worker's heartbeat
+#   done/<id>.pkl     shard result, batch palettes of the shard's images
+# Whitening or projection (if configured) is not fitted by the queue, `method1`/`method2` have to store
+# the transform artifact first, `plan` checks that it exists.
+QUEUE_FILE = "queue.json"
+
+
+def _palette_config(method: int):
+    return default_config.global_palette if method == 1 else default_config.local_palette
+
+
+def plan(queue: str, method: int, target: utils.ClassificationTarget, shard_size: int):
+    """Split training of `method` into shards of at most `shard_size` images of a single class."""
+    if os.path.exists(os.path.join(queue, QUEUE_FILE)):
+        raise FileExistsError(f"Queue {queue} is already planned")
+    try:
+        _load_transform(method, target)
+    except FileNotFoundError as error:
+        raise FileNotFoundError(f"Transform artifact {error.filename} is missing, "
+                                f"store it with method{method} before planning") from error
+    for directory in ("shards", "leases", "done"):
+        os.makedirs(os.path.join(queue, directory), exist_ok=True)
+    utils.write_atomic(os.path.join(queue, QUEUE_FILE), json.dumps({
+        "method": method,
+        "target": target.name,
+        "fingerprint": config_module.fingerprint(_palette_config(method)),
+    }).encode())
+
+    shard_count = 0
+    for cls, feature_paths in loader.BatchLoader.class_paths(target).items():
+        for offset in range(0, len(feature_paths), shard_size):
+            utils.write_atomic(os.path.join(queue, "shards", f"{shard_count:06d}.json"), json.dumps({
+                "cls": cls,
+                "paths": feature_paths[offset: offset + shard_size],
+            }).encode())
+            shard_count += 1
+
+
+class WorkQueue:
+    """Shards of a planned queue directory, claimed through exclusively created lease files."""
+
+    def __init__(self, queue: str, lease_seconds: float = 300.0):
+        self.queue = queue
+        self.lease_seconds = lease_seconds
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        with open(os.path.join(queue, QUEUE_FILE), "r") as queue_file:
+            self.spec = json.load(queue_file)
+
+    def _path(self, directory: str, shard_id: str, extension: str = "") -> str:
+        return os.path.join(self.queue, directory, f"{shard_id}{extension}")
+
+    @property
+    def shard_ids(self) -> list[str]:
+        return sorted(name.removesuffix(".json") for name in os.listdir(os.path.join(self.queue, "shards"))
+                      if name.endswith(".json"))
+
+    def is_done(self, shard_id: str) -> bool:
+        return os.path.exists(self._path("done", shard_id, ".pkl"))
+
+    @property
+    def finished(self) -> bool:
+        return all(map(self.is_done, self.shard_ids))
+
+    def _expired(self, lease: str) -> bool:
+        try:
+            return time.time() - os.stat(lease).st_mtime > self.lease_seconds
+        except FileNotFoundError:
+            return False
+
+    def claim(self) -> str | None:
+        """Lease a pending shard, taking over shards whose lease expired (crashed worker), or None."""
+        for shard_id in self.shard_ids:
+            if self.is_done(shard_id):
+                continue
+            lease = self._path("leases", shard_id)
+            if self._expired(lease):
+                # Another worker may have taken the expired lease over between the check and the rename, the
+                # renamed file is then that worker's fresh lease and is put back instead of being removed
+                expired = f"{lease}.expired.{self.worker_id}"
+                with contextlib.suppress(FileNotFoundError):
+                    os.rename(lease, expired)
+                    if not self._expired(expired):
+                        with contextlib.suppress(FileExistsError):
+                            os.link(expired, lease)
+                        os.remove(expired)
+                        continue
+                    os.remove(expired)
+            try:
+                descriptor = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+            with os.fdopen(descriptor, "w") as lease_file:
+                lease_file.write(self.worker_id)
+            # The shard may have been finished between the check above and creating the lease
+            if self.is_done(shard_id):
+                self.release(shard_id)
+                continue
+            return shard_id
+        return None
+
+    def owns(self, shard_id: str) -> bool:
+        """Whether the lease of `shard_id` is (still) held by this worker, it may have been taken over."""
+        try:
+            with open(self._path("leases", shard_id), "r") as lease_file:
+                return lease_file.read() == self.worker_id
+        except FileNotFoundError:
+            return False
+
+    @contextlib.contextmanager
+    def heartbeat(self, shard_id: str):
+        """Keep renewing the lease of `shard_id` while the body runs, until it is taken over."""
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.lease_seconds / 4):
+                if not self.owns(shard_id):
+                    # Renewing would keep the new owner's lease alive if this worker stalls
+                    return
+                with contextlib.suppress(FileNotFoundError):
+                    os.utime(self._path("leases", shard_id))
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, shard_id: str, result):
+        utils.write_atomic(self._path("done", shard_id, ".pkl"), pickle.dumps(result))
+        self.release(shard_id)
+
+    def release(self, shard_id: str):
+        """Remove the lease of `shard_id` unless another worker took it over meanwhile."""
+        if self.owns(shard_id):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path("leases", shard_id))
+
+    def shard(self, shard_id: str) -> dict:
+        with open(self._path("shards", shard_id, ".json"), "r") as shard_file:
+            return json.load(shard_file)
+
+    def result(self, shard_id: str):
+        with open(self._path("done", shard_id, ".pkl"), "rb") as result_file:
+            return pickle.load(result_file)
+
+
+def _load_transform(method: int, target: utils.ClassificationTarget) -> utils.PatchTransform | None:
+    import main
+
+    palette_config = _palette_config(method)
+    prefix = "global" if method == 1 else main.artifact_name("local", target)
+    return main.load_or_fit_transform(prefix, None, palette_config, pickling=False, loading=True)
+
+
+def run_shard(work_queue: WorkQueue, shard: dict) -> list:
+    """Batch palettes of the shard's images, the same palettes `method1`/`method2` compute per batch.
+
+    Requires the stored transform artifact when whitening or projection is configured.
+    """
+    method = work_queue.spec["method"]
+    palette_config = _palette_config(method)
+    transform = _load_transform(method, utils.ClassificationTarget[work_queue.spec["target"]])
+    return [palette.generate_palette(image_batch, palette_config, transform=transform)
+            for image_batch in loader.ImageIterator(shard["cls"], shard["paths"], (palette_config,))
+            if len(image_batch) > 0]
+
+
+def work(queue: str, lease_seconds: float = 300.0, poll_seconds: float = 5.0, processes: int = 1):
+    """Process shards until every shard of the queue is done, `processes` workers share this machine's budget."""
+    # Every process has its own governor, the configured budget is split evenly between them
+    memory.governor.limit(memory.governor.total // processes)
+    work_queue = WorkQueue(queue, lease_seconds)
+    if work_queue.spec["fingerprint"] != config_module.fingerprint(_palette_config(work_queue.spec["method"])):
+        raise ValueError(f"Config of worker {work_queue.worker_id} differs from the config queue was planned with")
+
+    while not work_queue.finished:
+        shard_id = work_queue.claim()
+        if shard_id is None:
+            # Remaining shards are leased by other workers, wait for them to finish or for leases to expire
+            time.sleep(poll_seconds)
+            continue
+        print(f"{work_queue.worker_id}: shard {shard_id}")
+        with work_queue.heartbeat(shard_id):
+            result = run_shard(work_queue, work_queue.shard(shard_id))
+        work_queue.complete(shard_id, result)
+    print(memory.governor.report())
+
+
+def reduce(queue: str, poll_seconds: float = 5.0):
+    """Wait for all shards and merge their palettes into the artifacts `method1`/`method2` load.
+
+    Requires the stored transform artifact when whitening or projection is configured.
+    """
+    work_queue = WorkQueue(queue)
+    while not work_queue.finished:
+        time.sleep(poll_seconds)
+
+    method = work_queue.spec["method"]
+    target = utils.ClassificationTarget[work_queue.spec["target"]]
+    palette_config = _palette_config(method)
+    class_palettes: dict[str, list] = dict()
+    for shard_id in tqdm(work_queue.shard_ids, desc="shards"):
+        class_palettes.setdefault(work_queue.shard(shard_id)["cls"], []).extend(work_queue.result(shard_id))
+
+    transform = _load_transform(method, target)
+
+    def pixels(merged: np.ndarray) -> np.ndarray:
+        return transform.inverse_transform(merged) if transform is not None else merged
+
+    if method == 1:
+        result = palette.merge_palettes([batch_palette for palettes in class_palettes.values()
+                                         for batch_palette in palettes], palette_config)
+        name = "global_palette"
+        reconstructed_name, reconstructed = "global_palette_reconstructed", pixels(result)
+        palette.save_palette_image(reconstructed, palette_config,
+                                   os.path.join(os.path.dirname(__file__), "global_palette.png"))
+    else:
+        import main
+
+        result = {cls: palette.merge_palettes(palettes, palette_config) for cls, palettes in class_palettes.items()}
+        name = main.artifact_name("local_palettes", target)
+        reconstructed_name = main.artifact_name("local_palettes_reconstructed", target)
+        reconstructed = {cls: pixels(cls_palette) for cls, cls_palette in result.items()}
+        palette_images_dir = os.path.join(os.path.dirname(__file__), main.artifact_name("loc_palette_images", target))
+        os.makedirs(palette_images_dir, exist_ok=True)
+        for cls, cls_palette in reconstructed.items():
+            palette.save_palette_image(cls_palette, palette_config,
+                                       os.path.join(palette_images_dir, f"{cls}.png"))
+    with open(os.path.join(os.path.dirname(__file__), name), "wb") as artifact:
+        pickle.dump(result, artifact)
+    if transform is not None:
+        with open(os.path.join(os.path.dirname(__file__), reconstructed_name), "wb") as artifact:
+            pickle.dump(reconstructed, artifact)
+    return result
+
+
+def local(queue: str, method: int, target: utils.ClassificationTarget, shard_size: int, processes: int,
+          lease_seconds: float):
+    """Plan, work with `processes` local worker processes and reduce, all on this machine.
+
+    An existing queue is resumed, shards finished by an interrupted run are not processed again.
+    """
+    if not os.path.exists(os.path.join(queue, QUEUE_FILE)):
+        plan(queue, method, target, shard_size)
+    workers = [multiprocessing.Process(target=work, args=(queue, lease_seconds, 1.0, processes))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return reduce(queue, 1.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded palette training over a shared directory work queue.")
+    parser.add_argument("command", choices=["plan", "work", "reduce", "local"])
+    parser.add_argument("--queue", type=str, required=True, help="Work queue directory shared by all workers")
+    parser.add_argument("--method", type=int, choices=[1, 2], default=2)
+    parser.add_argument("--target", type=str, default="ARTIST")
+    parser.add_argument("--shard-size", type=int, default=256, help="Images per shard")
+    parser.add_argument("--lease-seconds", type=float, default=300.0,
+                        help="Shards of workers silent for longer are re-leased to other workers")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Worker processes for `local`")
+    args = parser.parse_args()
+
+    target = utils.ClassificationTarget[args.target.upper()]
+    if args.command == "plan":
+        plan(args.queue, args.method, target, args.shard_size)
+    elif args.command == "work":
+        work(args.queue, args.lease_seconds)
+    elif args.command == "reduce":
+        reduce(args.queue)
+    else:
+        local(args.queue, args.method, target, args.shard_size, args.processes, args.lease_seconds)
+
+
+if __name__ == "__main__":
+    main()
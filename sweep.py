@@ -0,0 +1,254 @@
+import argparse
+import concurrent.futures
+import copy
+import dataclasses
+import itertools
+import json
+import os
+import time
+import typing
+
+import bitmath
+import numpy as np
+import pandas as pd
+import PIL
+from sklearn.neighbors import KNeighborsClassifier
+
+import config as config_module
+import loader
+import match
+import memory
+import palette
+import reduction
+import utils
+import whitening
+from config import default_config, GlobalPaletteConfig, LocalPaletteConfig
+
+# Emulate conditional compilation
+if config_module.PROFILE:
+    def tqdm(*args, **_):
+        return args[0]
+else:
+    from tqdm import tqdm
+
+
+# Grid keys that live in the `batching-k-means` subsection of a palette config
+K_MEANS_KEYS = ("batch-size", "max-iterations", "number-of-clusters")
+
+Overrides = dict[str, typing.Any]
+PaletteConfig = GlobalPaletteConfig | LocalPaletteConfig
+
+
+def grid_points(grid: dict[str, list]) -> list[Overrides]:
+    """Cartesian product of grid values, one dict of palette config overrides per grid point."""
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def palette_config(method: int, section: dict[str, typing.Any], overrides: Overrides) -> PaletteConfig:
+    """Build palette config of `method` from its config.json `section` with grid point `overrides` applied."""
+    section = copy.deepcopy(section)
+    for key, value in overrides.items():
+        if key in K_MEANS_KEYS:
+            section["batching-k-means"][key] = value
+        else:
+            section[key] = value
+    # Palette size always follows the number of clusters
+    section["size"] = section["batching-k-means"]["number-of-clusters"]
+    config = (GlobalPaletteConfig if method == 1 else LocalPaletteConfig).from_json(section)
+    config.parent = default_config
+    return config
+
+
+def sampling_key(config: PaletteConfig) -> tuple:
+    """Grid points with equal keys draw identical patch samples and can share them."""
+    return config.patch_size, config.coverage, config.predict_coverage, config.random, config.decode_scale
+
+
+@dataclasses.dataclass
+class PatchSamples:
+    """Training and validation patches drawn once for all grid points of one sampling key."""
+    config: PaletteConfig
+    max_patches_per_class: int
+    train: dict[str, list[np.ndarray]] = dataclasses.field(default_factory=dict)
+    val: list[tuple[np.ndarray, str]] = dataclasses.field(default_factory=list)
+
+    def train_count(self, cls: str) -> int:
+        return sum(len(patches) for patches in self.train.get(cls, []))
+
+    @property
+    def nbytes(self) -> int:
+        return (sum(patches.nbytes for cls_patches in self.train.values() for patches in cls_patches)
+                + sum(patches.nbytes for patches, _ in self.val))
+
+
+def sample_patches(
+        target: utils.ClassificationTarget,
+        samples: list[PatchSamples],
+        val_fraction: float
+):
+    """Fill all `samples` in a single pass over the dataset, decoding every image only once."""
+    configs = [sample.config for sample in samples]
+    loader.BatchLoader(target)
+
+    for cls, feature_paths in loader.BatchLoader._index[target].items():
+        for image_batch in tqdm(loader.ImageIterator(cls, feature_paths, configs), desc=cls):
+            for image in image_batch:
+                scale = image.info.get("decode-scale", 1)
+                image_array = utils.image_array(image)
+                for sample in samples:
+                    remaining = sample.max_patches_per_class - sample.train_count(cls)
+                    if remaining > 0:
+                        sample.train.setdefault(cls, []).append(
+                            utils.get_patches(image_array, sample.config, remaining, scale))
+            # Stop decoding the class as soon as no sample needs more of its patches
+            if all(sample.train_count(cls) >= sample.max_patches_per_class for sample in samples):
+                break
+
+    val_entries = pd.read_csv(
+        os.path.join(default_config.dataset_labels_path, f"{target.name.lower()}_val.csv"),
+        names=["path", "encoded_cls"]).sample(frac=val_fraction, random_state=default_config.random_seed)
+    class_encoding = loader.BatchLoader._cls_encoding(target)
+    for _, entry in tqdm(val_entries.iterrows(), desc="validation", total=len(val_entries)):
+        try:
+            with PIL.Image.open(os.path.join(default_config.dataset_path, entry["path"])) as image:
+                scale = utils.draft(image, *configs)
+                image_array = utils.image_array(image)
+        except FileNotFoundError:
+            continue
+        for sample in samples:
+            sample.val.append((
+                utils.get_patches(image_array, sample.config, sample.config.predict_coverage, scale),
+                class_encoding[entry["encoded_cls"]]
+            ))
+
+
+def estimate_memory(method: int, config: PaletteConfig, samples: PatchSamples) -> int:
+    """Rough peak bytes of training one grid point: float64 copies of the patches k-means sees at once."""
+    dimension = config.patch_size * config.patch_size * 3
+    counts = [samples.train_count(cls) for cls in samples.train]
+    fitted_count = sum(counts) if method == 1 else max(counts, default=0)
+    return 2 * 8 * fitted_count * dimension + 8 * len(counts) * config.batching_k_means.number_of_clusters * dimension
+
+
+def run_point(method: int, config: PaletteConfig, samples: PatchSamples) -> dict[str, float]:
+    """Train and validate one grid point on shared patch samples."""
+    train_start = time.perf_counter()
+    train = {cls: np.vstack(cls_patches) for cls, cls_patches in samples.train.items()}
+    transform = None
+    if config.whitening:
+        transform = whitening.ZCAWhitening(config.patch_size * config.patch_size * 3)
+        for cls_patches in train.values():
+            transform.partial_fit(cls_patches)
+        transform.finalize()
+    elif config.reduced_dimension:
+        all_patches = np.vstack(list(train.values()))
+        sample = np.random.default_rng(default_config.random_seed).choice(
+            all_patches.shape[0], min(config.reduction_sample_size, all_patches.shape[0]), replace=False)
+        transform = reduction.PatchProjection(config.reduction, config.reduced_dimension,
+                                              default_config.random_seed).fit(all_patches[sample])
+        del all_patches
+    if transform is not None:
+        train = {cls: transform.transform(cls_patches) for cls, cls_patches in train.items()}
+    if method == 1:
+        global_palette = palette.fit_palette(np.vstack(list(train.values())), config)
+        neighbours = KNeighborsClassifier(n_neighbors=1).fit(global_palette, np.arange(global_palette.shape[0]))
+        class_histograms = dict()
+        for cls, cls_patches in train.items():
+            distances, neighbors = utils.k_closest(cls_patches, global_palette, config.soft_assignment_k, neighbours)
+            class_histograms[cls] = utils.histogram(
+                neighbors, global_palette.shape[0], distances if config.soft_assignment_k > 1 else None
+            ) / len(cls_patches)
+    else:
+        local_palettes = {cls: palette.fit_palette(cls_patches, config) for cls, cls_patches in train.items()}
+        local_neighbours = {
+            cls: KNeighborsClassifier(n_neighbors=1).fit(cls_palette, np.arange(cls_palette.shape[0]))
+            for cls, cls_palette in local_palettes.items()
+        }
+    train_seconds = time.perf_counter() - train_start
+
+    correct = 0
+    inference_start = time.perf_counter()
+    for patches, target in samples.val:
+        if transform is not None:
+            patches = transform.transform(patches)
+        if method == 1:
+            distances, neighbors = utils.k_closest(patches, global_palette, config.soft_assignment_k, neighbours)
+            histogram = utils.histogram(
+                neighbors, global_palette.shape[0], distances if config.soft_assignment_k > 1 else None)
+            # Normalized like the class histograms so that images of any size are comparable
+            scores = match.scores1(histogram / len(patches), class_histograms)
+        else:
+            scores = match.scores2({
+                cls: utils.k_closest(patches, cls_palette, config.k_neigh, local_neighbours[cls])
+                for cls, cls_palette in local_palettes.items()
+            })
+        correct += (min(scores, key=scores.get) == target)
+    inference_seconds = time.perf_counter() - inference_start
+
+    return {
+        "accuracy": correct / max(len(samples.val), 1),
+        "train_seconds": train_seconds,
+        "images_per_second": len(samples.val) / inference_seconds if inference_seconds > 0 else float("nan"),
+    }
+
+
+def sweep(spec: dict[str, typing.Any]) -> pd.DataFrame:
+    """Run every grid point of `spec`, see sweep.json for its format."""
+    method = int(spec["method"])
+    target = utils.ClassificationTarget[spec.get("target", "ARTIST")]
+    memory_budget = int(bitmath.parse_string(spec.get("memory-budget", "4 GiB")).to_Byte())
+    with open(spec.get("config", "./config.json"), "r") as config_file:
+        section = json.load(config_file)["global-palette" if method == 1 else "local-palette"]
+
+    points = grid_points(spec["grid"])
+    configs = [palette_config(method, section, overrides) for overrides in points]
+
+    # Grid points run under the sweep's budget, the global one only applies if it is smaller
+    memory.governor.limit(memory_budget)
+    # Half of the budget holds shared samples (split evenly over sampling keys and classes), half trains
+    keys = list(dict.fromkeys(map(sampling_key, configs)))
+    class_count = len(loader.BatchLoader(target)._index[target])
+    samples: dict[tuple, PatchSamples] = dict()
+    for config in configs:
+        key = sampling_key(config)
+        if key not in samples:
+            patch_bytes = config.patch_size * config.patch_size * 3
+            samples[key] = PatchSamples(config, memory_budget // (2 * len(keys) * class_count * patch_bytes))
+    sample_patches(target, list(samples.values()), float(spec.get("val-fraction", 0.1)))
+    print(f"Shared samples: {bitmath.Byte(sum(sample.nbytes for sample in samples.values())).best_prefix()}")
+
+    samples_bytes = sum(sample.nbytes for sample in samples.values())
+
+    # Grid points reserve their training estimate from what the samples leave, a point estimated larger
+    # than that runs alone. Reservations of fits inside a point are nested in its reservation.
+    def run(config: PaletteConfig) -> dict[str, float]:
+        point_samples = samples[sampling_key(config)]
+        estimate = min(estimate_memory(method, config, point_samples), memory.governor.total - samples_bytes)
+        with memory.governor.reserve("sweep point", estimate):
+            return run_point(method, config, point_samples)
+
+    # Samples are held for the whole sweep, training only gets the rest of the budget
+    with memory.governor.reserve("samples", samples_bytes):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=int(spec.get("workers", os.cpu_count()))) as executor:
+            results = list(tqdm(executor.map(run, configs), desc="grid points", total=len(configs)))
+    print(memory.governor.report())
+
+    return pd.DataFrame([overrides | result for overrides, result in zip(points, results)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep palette configuration parameters.")
+    parser.add_argument("spec", type=str, nargs="?", default="./sweep.json", help="Path to the sweep specification")
+    args = parser.parse_args()
+
+    with open(args.spec, "r") as spec_file:
+        spec = json.load(spec_file)
+
+    results = sweep(spec)
+    results.to_csv(spec.get("output", "./sweep-results.csv"), index=False)
+    print(results.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
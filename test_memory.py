@@ -0,0 +1,49 @@
+import threading
+
+import memory
+
+
+def test_nested_reservations_of_concurrent_threads_do_not_deadlock():
+    governor = memory.MemoryGovernor(100)
+    both_outer = threading.Barrier(2)
+    finished = list()
+
+    def point():
+        with governor.reserve("sweep point", 40):
+            # Both outer reservations are held, only 20 bytes are left for the nested ones
+            both_outer.wait()
+            with governor.reserve("k-means", 30):
+                finished.append(threading.get_ident())
+
+    threads = [threading.Thread(target=point, daemon=True) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert len(finished) == 2
+    assert governor.available == governor.total
+
+
+def test_top_level_reservation_waits_for_budget():
+    governor = memory.MemoryGovernor(100)
+    held, acquired = threading.Event(), threading.Event()
+    release = threading.Event()
+
+    def holder():
+        with governor.reserve("loader", 80):
+            held.set()
+            release.wait(10)
+
+    def waiter():
+        with governor.reserve("patches", 40):
+            acquired.set()
+
+    threading.Thread(target=holder, daemon=True).start()
+    assert held.wait(10)
+    thread = threading.Thread(target=waiter, daemon=True)
+    thread.start()
+    assert not acquired.wait(0.2)
+    release.set()
+    assert acquired.wait(10)
+    thread.join(10)
+    assert governor.available == governor.total
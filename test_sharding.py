@@ -0,0 +1,59 @@
+import json
+import multiprocessing
+import os
+import time
+
+import sharding
+
+
+def _queue(directory: str, shard_count: int = 1) -> str:
+    """Queue directory with `shard_count` single image shards, planned without the dataset."""
+    for name in ("shards", "leases", "done"):
+        os.makedirs(os.path.join(directory, name))
+    with open(os.path.join(directory, sharding.QUEUE_FILE), "w") as queue_file:
+        json.dump({"method": 2, "target": "ARTIST", "fingerprint": ""}, queue_file)
+    for shard in range(shard_count):
+        with open(os.path.join(directory, "shards", f"{shard:06d}.json"), "w") as shard_file:
+            json.dump({"cls": "cls", "paths": [f"{shard}.jpg"]}, shard_file)
+    return directory
+
+
+def _claim_and_hang(queue: str, lease_seconds: float, claimed):
+    work_queue = sharding.WorkQueue(queue, lease_seconds)
+    shard_id = work_queue.claim()
+    with work_queue.heartbeat(shard_id):
+        claimed.set()
+        time.sleep(3600)
+
+
+def test_killed_worker_shard_is_released(tmp_path):
+    queue = _queue(str(tmp_path))
+    lease_seconds = 0.5
+    claimed = multiprocessing.Event()
+    worker = multiprocessing.Process(target=_claim_and_hang, args=(queue, lease_seconds, claimed))
+    worker.start()
+    assert claimed.wait(30)
+
+    # Leased and heartbeated by the worker
+    other = sharding.WorkQueue(queue, lease_seconds)
+    assert other.claim() is None
+
+    worker.kill()
+    worker.join()
+    time.sleep(2 * lease_seconds)
+    assert other.claim() == "000000"
+    assert other.owns("000000")
+
+
+def test_taken_over_lease_is_kept(tmp_path):
+    queue = _queue(str(tmp_path))
+    stalled = sharding.WorkQueue(queue, lease_seconds=0.2)
+    assert stalled.claim() == "000000"
+    time.sleep(0.4)
+
+    successor = sharding.WorkQueue(queue, lease_seconds=0.2)
+    assert successor.claim() == "000000"
+    # The stalled worker finishing late must not free the successor's lease
+    stalled.release("000000")
+    assert successor.owns("000000")
+    assert not stalled.owns("000000")
@@ -3,6 +3,7 @@ import dataclasses
 import itertools
 import json
 import os
+import typing
 from typing import Iterator
 
 import numpy as np
@@ -13,6 +14,7 @@ from PIL.Image import Image
 
 import config
 import loader
+import metadata
 from config import Config, default_config
 
 from utils import ClassificationTarget
@@ -129,24 +131,9 @@ def dataset_to_hdf5(images: np.ndarray):
 
 
 def compression_ratios(target: ClassificationTarget, config: Config):
-    _ = BatchLoader(target, config)
-    compression_data = list()
-
-    for cls, feature_paths in list(BatchLoader._index[target].items())[5:10]:
-        for file in tqdm(feature_paths, desc=cls):
-            image_path = os.path.join(config.dataset_path, file)
-
-            with PIL.Image.open(image_path) as img:
-                compression_data.append([
-                    image_path,
-                    cls,
-                    img.size,
-                    bitmath.Byte(os.path.getsize(image_path)).to_MiB(),
-                    bitmath.Byte(img.size[0] * img.size[1] * len(img.getbands())).to_MiB()
-                ])
-
-    df = pd.DataFrame(compression_data, columns=["path", "class", "dims", "compressed-size", "decompressed-size"])
-    print((df["decompressed-size"] / df["compressed-size"]).mean())
+    table = metadata.table()
+    target_info = TargetInfo(target, table if table is not None else metadata.build())
+    print(target_info.compression_ratio())
 
 
 # All serialize to json
@@ -156,6 +143,13 @@ def compression_ratios(target: ClassificationTarget, config: Config):
 class ImageInfo:
     width: int
     height: int
+    bands: int = 3
+    file_size: int = 0
+
+    @classmethod
+    def from_row(cls, row: pd.Series) -> typing.Self:
+        return cls(width=int(row["width"]), height=int(row["height"]), bands=int(row["bands"]),
+                   file_size=int(row["file_size"]))
 
     @property
     def area(self) -> int:
@@ -163,33 +157,55 @@ class ImageInfo:
 
     @property
     def bytes_size(self) -> bitmath.Byte:
-        raise NotImplementedError()
+        return bitmath.Byte(self.area * self.bands)
+
+    @property
+    def compression_ratio(self) -> float:
+        return self.area * self.bands / self.file_size
 
 
 @dataclasses.dataclass
 class ClassInfo:
-    paths: list[ImageInfo]
-    total_size: int
-    paths: str
-    resolutions: list[(int, int)]
+    paths: list[str]
+    images: list[ImageInfo]
+
+    @property
+    def total_size(self) -> bitmath.Byte:
+        return bitmath.Byte(sum(image.area * image.bands for image in self.images))
 
-    def resolutions_hist(self):
-        """Return histogram of areas (% 10?) of images for this class. (data for bar plot)"""
-        raise NotImplementedError()
+    @property
+    def resolutions(self) -> list[tuple[int, int]]:
+        return [(image.width, image.height) for image in self.images]
+
+    def resolutions_hist(self, bins: int = 10) -> tuple[np.ndarray, np.ndarray]:
+        """Return histogram of areas of images for this class (counts, bin edges; data for bar plot)."""
+        return np.histogram([image.area for image in self.images], bins=bins)
 
 
 @dataclasses.dataclass
 class TargetInfo:
+    """Dataset statistics of a classification target computed from the metadata table alone."""
     target: ClassificationTarget
+    table: pd.DataFrame
 
     def compression_ratio(self) -> float:
-        raise NotImplementedError()
+        paths = [path for cls_info in self.class_data().values() for path in cls_info.paths]
+        rows = self.table.loc[paths]
+        return float((rows["width"] * rows["height"] * rows["bands"] / rows["file_size"]).mean())
 
     def class_data(self) -> dict[str, ClassInfo]:
-        raise NotImplementedError()
+        class_data = dict()
+        for cls, entries in BatchLoader.class_paths(self.target).items():
+            paths = [path for entry in entries for path in metadata.image_files(entry) if path in self.table.index]
+            rows = self.table.loc[paths]
+            class_data[cls] = ClassInfo(paths, [ImageInfo.from_row(row) for _, row in rows.iterrows()])
+        return class_data
 
-    def class_total_img_size(self) -> bitmath.Byte:
-        raise NotImplementedError()
+    def class_total_img_size(self, cls: str) -> bitmath.Byte:
+        paths = [path for entry in BatchLoader.class_paths(self.target)[cls]
+                 for path in metadata.image_files(entry) if path in self.table.index]
+        rows = self.table.loc[paths]
+        return bitmath.Byte(int((rows["width"] * rows["height"] * rows["bands"]).sum()))
 
 
 def visualize_dataset(all=False):
@@ -256,6 +272,28 @@ def visualize_dataset(all=False):
         plt.savefig(file_name)
         plt.close()  # Close the plot to avoid displaying it
 
+        # Decoded pixel data per class, read from the metadata table so no image file is opened
+        table = metadata.table()
+        if table is not None:
+            class_sizes = dict()
+            for cls, entries in index[target].items():
+                paths = [path for entry in entries for path in metadata.image_files(entry) if path in table.index]
+                rows = table.loc[paths]
+                class_sizes[cls] = bitmath.Byte(int((rows["width"] * rows["height"] * rows["bands"]).sum())).to_GiB()
+
+            plt.figure(figsize=(10, fig_height))
+            plt.bar(class_sizes.keys(), [float(size) for size in class_sizes.values()])
+            plt.title(f"Decoded Data Size for {target.name}")
+            plt.xlabel("Encoded Class")
+            plt.ylabel("Decoded Size [GiB]")
+            plt.xticks(rotation=45, ha='right')
+            plt.gca().margins(x=0.01)
+            plt.subplots_adjust(bottom=0.15)
+
+            file_name = f"size-{target.name.lower()}.jpg"
+            plt.savefig(file_name)
+            plt.close()
+
 
 class LoadingStrategy:
     @staticmethod
@@ -1,17 +1,35 @@
 import enum
+import os
+import typing
+import uuid
 
 import matplotlib as plt
 import numpy as np
+import scipy.sparse
 
 from PIL import Image
 from sklearn.feature_extraction.image import extract_patches_2d
 from sklearn.neighbors import KNeighborsClassifier
 
 import config
+import memory
 from config import default_config
 from config import LocalPaletteConfig, GlobalPaletteConfig
 
 
+class PatchTransform(typing.Protocol):
+    """Fitted patch space transform (`whitening.ZCAWhitening`, `reduction.PatchProjection`).
+
+    Palettes are trained on transformed patches, so query patches must be transformed the same way.
+    """
+
+    def transform(self, patches: np.ndarray) -> np.ndarray:
+        ...
+
+    def inverse_transform(self, transformed: np.ndarray) -> np.ndarray:
+        ...
+
+
 class ClassificationTarget(enum.Enum):
     """Enumeration representing the target features for classification."""
     ARTIST = enum.auto()
@@ -41,20 +59,115 @@ def read_image(path: str):
     return image
 
 
-def get_patches(image: np.ndarray, config: GlobalPaletteConfig | LocalPaletteConfig, max_patch_count: int | float):
-    height, width = image.shape[0], image.shape[1]
-    assert height >= config.patch_size and width >= config.patch_size
+def write_atomic(path: str, data: bytes):
+    """Readers see either no file or the complete file, never a partially written one."""
+    temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
 
-    # FIXME: should this use min?
-    sample_count = int(
-        min(config.coverage
+
+# Scales supported by libjpeg DCT-domain downscaling (PIL draft mode)
+DRAFT_SCALES = (1, 2, 4, 8)
+
+
+def decode_scale(config: GlobalPaletteConfig | LocalPaletteConfig) -> int:
+    """Largest draft scale up to `config.decode_scale` for which sampling density stays below one patch per position."""
+    density = max(config.coverage, config.predict_coverage)
+    # Strictly below one, `extract_patches_2d` only accepts fractional `max_patches` in (0, 1)
+    return max(scale for scale in DRAFT_SCALES
+               if scale == 1 or (scale <= config.decode_scale and density * scale * scale < 1.0))
+
+
+def draft_scale(
+        size: tuple[int, int],
+        image_format: str | None,
+        *configs: GlobalPaletteConfig | LocalPaletteConfig
+) -> int:
+    """Draft scale `draft` picks for an image of `size` and `image_format`, computable from its header alone."""
+    if image_format != "JPEG" or not configs:
+        return 1
+    scale = min(decode_scale(config) for config in configs)
+    patch_size = max(config.patch_size for config in configs)
+    while scale > 1 and min(size) // scale < patch_size:
+        scale //= 2
+    return scale
+
+
+def draft(image: Image.Image, *configs: GlobalPaletteConfig | LocalPaletteConfig) -> int:
+    """Request reduced-resolution decoding of not yet loaded JPEG `image`, return the scale it is decoded at.
+
+    With multiple `configs` the image is decoded once at the largest scale all of them allow.
+    """
+    if "decode-scale" in image.info:
+        return image.info["decode-scale"]
+    image.info["decode-size"] = image.size
+    scale = draft_scale(image.size, image.format, *configs)
+    applied = 1
+    if scale > 1:
+        original_width = image.width
+        if image.draft("RGB", (image.width // scale, image.height // scale)) is not None:
+            applied = round(original_width / image.width)
+    image.info["decode-scale"] = applied
+    return applied
+
+
+def image_array(image: Image.Image) -> np.ndarray:
+    return np.asarray(image, dtype='B').reshape(image.height, image.width, len(image.getbands()))
+
+
+def decode(image: Image.Image, config: GlobalPaletteConfig | LocalPaletteConfig) -> tuple[np.ndarray, int]:
+    """Pixels of `image` at the scale `config` allows and that scale, whichever configs the image was drafted for.
+
+    An image drafted for a config allowing less downscaling (e.g. by the loader for another palette) is
+    reduced further in memory, so every config samples at its own `decode_scale`.
+    """
+    applied = draft(image, config)
+    wanted = draft_scale(image.info.get("decode-size", image.size), image.format, config)
+    if wanted > applied:
+        factor = wanted // applied
+        return image_array(image.reduce(factor)), applied * factor
+    return image_array(image), applied
+
+
+def sample_count(
+        height: int,
+        width: int,
+        config: GlobalPaletteConfig | LocalPaletteConfig,
+        max_patch_count: int,
+        scale: int = 1
+) -> int:
+    """Number of patches `get_patches` samples from an image of given (decoded) dimensions."""
+    return int(
+        min(min(1.0, config.coverage * scale * scale)
             * (height - config.patch_size + 1)
             * (width - config.patch_size + 1),
             max_patch_count
             )
-    ) if type(max_patch_count) is int else max_patch_count
+    )
+
+
+def get_patches(
+        image: np.ndarray,
+        config: GlobalPaletteConfig | LocalPaletteConfig,
+        max_patch_count: int | float,
+        scale: int = 1
+):
+    """Sample patches from `image`, `scale` is the draft scale it was decoded at (coverage is scaled to match)."""
+    height, width = image.shape[0], image.shape[1]
+    assert height >= config.patch_size and width >= config.patch_size
+
+    # FIXME: should this use min?
+    if type(max_patch_count) is int:
+        count = sample_count(height, width, config, max_patch_count, scale)
+    else:
+        # Fractions of one or more mean every position, which `extract_patches_2d` expresses as None
+        count = max_patch_count * scale * scale
+        count = count if count < 1.0 else None
     if config.random:
-        patches = extract_patches_2d(image, (config.patch_size, config.patch_size), max_patches=sample_count).reshape(
+        patches = extract_patches_2d(image, (config.patch_size, config.patch_size), max_patches=count).reshape(
             (-1, config.patch_size * config.patch_size * 3))
     else:
         raise NotImplementedError("Efficient non-random sampling is not implemented")
@@ -85,19 +198,73 @@ def get_patches(image: np.ndarray, config: GlobalPaletteConfig | LocalPaletteCon
 
 def k_closest(patches: np.ndarray, palette: np.ndarray, k: int, neigh: KNeighborsClassifier | None = None):
     # TODO: run with n_jobs? - to test
-    if neigh is not None:
+    if neigh is None:
         neigh = KNeighborsClassifier(n_neighbors=k)
         neigh.fit(palette, np.arange(palette.shape[0]))
-    closest = neigh.kneighbors(patches)
+    # Bound the (queries x palette) distance block of every kneighbors call by the search chunk budget
+    chunk_size = max(1, int(default_config.memory.search_chunk.to_Byte()) // (8 * palette.shape[0]))
+    if patches.shape[0] <= chunk_size:
+        with memory.governor.reserve("search", 8 * patches.shape[0] * palette.shape[0]):
+            return neigh.kneighbors(patches, n_neighbors=k)
+
+    distances = np.empty((patches.shape[0], k))
+    indices = np.empty((patches.shape[0], k), dtype=np.intp)
+    with memory.governor.reserve("search", 8 * chunk_size * palette.shape[0]):
+        for offset in range(0, patches.shape[0], chunk_size):
+            chunk_distances, chunk_indices = neigh.kneighbors(patches[offset: offset + chunk_size], n_neighbors=k)
+            distances[offset: offset + len(chunk_indices)] = chunk_distances
+            indices[offset: offset + len(chunk_indices)] = chunk_indices
+    return distances, indices
+
+
+def soft_weights(distances: np.ndarray, eps: float = 1e-6) -> np.ndarray:
+    """Inverse distance weights over each patch's k nearest palette rows, summing to 1 per patch."""
+    inverse = 1.0 / (distances + eps)
+    return inverse / inverse.sum(axis=1, keepdims=True)
+
+
+def batch_histograms(
+        neighbors: list[np.ndarray],
+        palette_size: int,
+        distances: list[np.ndarray] | None = None,
+        sparse: bool = False
+) -> np.ndarray | scipy.sparse.csr_matrix:
+    """Histograms of palette indices for a batch of images, one row per image.
+
+    `neighbors[i]` holds the (patches, k) nearest palette indices of image i. Every index is counted,
+    including repeated ones. With `distances` each patch's unit weight is spread over its k neighbours
+    by inverse distance (soft assignment), otherwise each neighbour counts once. With `sparse` the result
+    is a CSR matrix which avoids (images x palette) dense storage for large palettes.
+    """
+    rows = np.repeat(np.arange(len(neighbors)), [image_neighbors.size for image_neighbors in neighbors])
+    columns = np.concatenate([image_neighbors.ravel() for image_neighbors in neighbors]).astype(np.intp)
+    weights = None
+    if distances is not None:
+        weights = np.concatenate([soft_weights(image_distances).ravel() for image_distances in distances])
+
+    if sparse:
+        if weights is None:
+            weights = np.ones(columns.shape[0])
+        # Duplicate (row, column) entries are summed on conversion to CSR
+        return scipy.sparse.coo_matrix((weights, (rows, columns)), shape=(len(neighbors), palette_size)).tocsr()
+    # Offsetting each image's indices by its row turns the whole batch into a single bincount
+    counts = np.bincount(rows * palette_size + columns, weights=weights, minlength=len(neighbors) * palette_size)
+    return counts.reshape(len(neighbors), palette_size).astype(float)
+
 
-    return closest
+def histogram(neighbors: np.ndarray, palette_size: int, distances: np.ndarray | None = None) -> np.ndarray:
+    return batch_histograms([neighbors], palette_size, None if distances is None else [distances])[0]
 
 
-def histogram(neighbors: np.ndarray, palette_size: int) -> np.ndarray:
-    neighbors = neighbors.flatten()
-    hist = np.zeros((palette_size,))
-    hist[neighbors] += 1
-    return hist
+def lookup_histogram(image: np.ndarray, lookup_table: np.ndarray, palette_size: int) -> np.ndarray:
+    """Histogram of palette indices of every pixel in `image` using table from `palette.build_lookup_table`."""
+    bits = lookup_table.shape[0].bit_length() - 1
+    shift = 8 - bits
+    if image.shape[2] == 1:
+        image = np.repeat(image, 3, axis=2)
+    quantized = (image[..., :3].reshape(-1, 3) >> shift).astype(np.intp)
+    flat_index = (quantized[:, 0] << (2 * bits)) | (quantized[:, 1] << bits) | quantized[:, 2]
+    return np.bincount(lookup_table.ravel()[flat_index], minlength=palette_size).astype(float)
 
 
 def plot_image(x, size):
@@ -0,0 +1,84 @@
+import sys
+
+import numpy as np
+
+import config as config_module
+import utils
+
+# Emulate conditional compilation
+if config_module.PROFILE:
+    def tqdm(*args, **_):
+        return args[0]
+else:
+    from tqdm import tqdm
+
+
+class ZCAWhitening:
+    """ZCA whitening (of per dimension standardized patches) fitted from streamed chunks.
+
+    Sums of patches and of their outer products are accumulated in float64, so fitting needs memory for
+    one chunk plus a (dimension x dimension) matrix regardless of how many patches are seen. The fitted
+    transform is applied in float32 batches and is meant to be pickled next to the palettes it produced,
+    so that query patches are whitened exactly like training patches.
+    """
+
+    def __init__(self, dimension: int, eps: float = 0.1):
+        self.dimension = dimension
+        self.eps = eps
+        self.count = 0
+        self._sum = np.zeros(dimension)
+        self._outer_sum = np.zeros((dimension, dimension))
+        self.mean: np.ndarray | None = None
+        self.matrix: np.ndarray | None = None
+        self.inverse_matrix: np.ndarray | None = None
+
+    def partial_fit(self, patches: np.ndarray) -> "ZCAWhitening":
+        patches = patches.astype(np.float64)
+        self.count += patches.shape[0]
+        self._sum += patches.sum(axis=0)
+        self._outer_sum += patches.T @ patches
+        return self
+
+    def finalize(self) -> "ZCAWhitening":
+        """Compute the transform from accumulated statistics, sums are dropped afterwards."""
+        assert self.count > 1, "whitening needs at least two patches"
+        mean = self._sum / self.count
+        covariance = (self._outer_sum - self.count * np.outer(mean, mean)) / (self.count - 1)
+        std = np.sqrt(np.clip(np.diag(covariance), np.finfo(np.float64).eps, None))
+        correlation = covariance / np.outer(std, std)
+        eigenvalues, eigenvectors = np.linalg.eigh(correlation)
+        eigenvalues = np.clip(eigenvalues, 0, None)
+
+        zca = eigenvectors @ np.diag(1.0 / np.sqrt(eigenvalues + self.eps)) @ eigenvectors.T
+        # Standardization is folded into the matrix: x_white = (x - mean) @ matrix
+        self.mean = mean.astype(np.float32)
+        self.matrix = (np.diag(1.0 / std) @ zca).astype(np.float32)
+        self.inverse_matrix = (eigenvectors @ np.diag(np.sqrt(eigenvalues + self.eps)) @ eigenvectors.T
+                               @ np.diag(std)).astype(np.float32)
+        self._sum, self._outer_sum = None, None
+        return self
+
+    def transform(self, patches: np.ndarray, chunk_size: int = 1 << 14) -> np.ndarray:
+        assert self.matrix is not None, "whitening is not fitted"
+        whitened = np.empty((patches.shape[0], self.dimension), dtype=np.float32)
+        for offset in range(0, patches.shape[0], chunk_size):
+            chunk = patches[offset: offset + chunk_size].astype(np.float32)
+            whitened[offset: offset + len(chunk)] = (chunk - self.mean) @ self.matrix
+        return whitened
+
+    def inverse_transform(self, whitened: np.ndarray) -> np.ndarray:
+        """Map whitened patches (e.g. palette entries) back to pixel space, for plotting."""
+        assert self.inverse_matrix is not None, "whitening is not fitted"
+        return whitened.astype(np.float32) @ self.inverse_matrix + self.mean
+
+
+def fit_whitening(image_iterators, config: config_module.GlobalPaletteConfig | config_module.LocalPaletteConfig):
+    """Fit whitening for `config` in one pass over `loader.ImageIterator`s, one image's patches at a time."""
+    whitening = ZCAWhitening(config.patch_size * config.patch_size * 3)
+    for image_iterator in image_iterators:
+        for image_batch in tqdm(image_iterator, desc=" whitening"):
+            for image in image_batch:
+                pixels, scale = utils.decode(image, config)
+                # Only coverage limits how many patches an image contributes
+                whitening.partial_fit(utils.get_patches(pixels, config, sys.maxsize, scale))
+    return whitening.finalize()